@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Tests of the retention policy, which snapshots expire."""
+
+
+# imports
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import vacap  # noqa: E402
+
+
+##############################################################################
+
+
+def get_policy(**policy):
+    """Return a policy that keeps everything, but for the given rules."""
+    return dict({"last": 0, "daily": 0, "weekly": 0, "monthly": 0,
+                 "max_size": 0}, **policy)
+
+
+def get_snapshots(count, step=timedelta(hours=6)):
+    """Return count snapshot names, oldest first, step apart."""
+    start = datetime(2024, 1, 1)
+    return [(start + step * number).strftime(vacap.SNAPSHOT_FORMAT)
+            for number in range(count)]
+
+
+class TestSelectExpired(unittest.TestCase):
+
+    """Check select_expired, it never opens a file."""
+
+    def test_empty_policy_keeps_everything(self):
+        """A policy of zeros never expires anything."""
+        self.assertEqual(vacap.select_expired(get_snapshots(5),
+                                              get_policy()), [])
+
+    def test_keep_last(self):
+        """Only the last N are kept."""
+        snapshots = get_snapshots(5)
+        self.assertEqual(vacap.select_expired(snapshots, get_policy(last=2)),
+                         snapshots[:3])
+
+    def test_keep_daily(self):
+        """The newest snapshot of each of the last N days is kept."""
+        snapshots = get_snapshots(12)  # 3 days, 4 snapshots each
+        self.assertEqual(
+            vacap.select_expired(snapshots, get_policy(daily=2)),
+            snapshots[:7] + snapshots[8:11])
+
+    def test_incremental_keeps_its_bases(self):
+        """A kept incremental keeps its base, and the base of its base."""
+        snapshots = get_snapshots(4)
+        needs = {snapshots[3]: {snapshots[2]}, snapshots[2]: {snapshots[1]}}
+        self.assertEqual(vacap.select_expired(snapshots, get_policy(last=1),
+                                              needs), snapshots[:1])
+
+    def test_protected(self):
+        """Protected snapshots are kept with their bases."""
+        snapshots = get_snapshots(4)
+        needs = {snapshots[1]: {snapshots[0]}}
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(last=1), needs, protected=[snapshots[1]]),
+            [snapshots[2]])
+
+    def test_max_size(self):
+        """The oldest expire while the total is too big, never the newest."""
+        snapshots = get_snapshots(4)
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(max_size=25),
+            measure=lambda kept: 10 * len(kept)), snapshots[:2])
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(max_size=1),
+            measure=lambda kept: 10 * len(kept)), snapshots[:3])
+
+    def test_per_origin(self):
+        """An origin backed up less often keeps its own last N."""
+        snapshots = get_snapshots(6)
+        origins = {name: {"daily"} for name in snapshots}
+        origins[snapshots[0]] = {"weekly"}
+        origins[snapshots[3]] = {"daily", "weekly"}
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(last=2), origins=origins), snapshots[1:3])
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(last=1), origins=origins),
+            snapshots[:3] + snapshots[4:5])
+        origins[snapshots[3]] = {"daily"}
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(last=1), origins=origins),
+            snapshots[1:5])
+
+    def test_per_origin_max_size_keeps_newest_of_each(self):
+        """max_size never expires the newest snapshot of an origin."""
+        snapshots = get_snapshots(4)
+        origins = {snapshots[0]: {"weekly"}, snapshots[1]: {"daily"},
+                   snapshots[2]: {"daily"}, snapshots[3]: {"daily"}}
+        self.assertEqual(vacap.select_expired(
+            snapshots, get_policy(max_size=1),
+            measure=lambda kept: 10 * len(kept), origins=origins),
+            snapshots[1:3])
+
+
+if __name__ in '__main__':
+    unittest.main()
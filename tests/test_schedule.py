@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Tests of the cron parser and the scheduler fire times."""
+
+
+# imports
+import os
+import shutil
+import sys
+import unittest
+from datetime import datetime
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import vacap  # noqa: E402
+
+
+##############################################################################
+
+
+class TestCronSchedule(unittest.TestCase):
+
+    """Parse cron expressions and compute their next fire time."""
+
+    def test_parse_fields(self):
+        """Lists, ranges, steps, names and macros are parsed to sets."""
+        cron = vacap.CronSchedule("*/15 9-17 1,15 jan-mar mon-fri")
+        self.assertEqual(cron.minutes, {0, 15, 30, 45})
+        self.assertEqual(cron.hours, set(range(9, 18)))
+        self.assertEqual(cron.days, {1, 15})
+        self.assertEqual(cron.months, {1, 2, 3})
+        self.assertEqual(cron.week_days, {1, 2, 3, 4, 5})
+        self.assertEqual(vacap.CronSchedule("5/20 * * * *").minutes,
+                         {5, 25, 45})
+        self.assertEqual(vacap.CronSchedule("0 0 * * 7").week_days, {0})
+        self.assertEqual(vacap.CronSchedule("@daily").hours, {0})
+
+    def test_invalid(self):
+        """Bad expressions raise ValueError."""
+        for expression in ("", "* * * *", "60 * * * *", "* 24 * * *",
+                           "0 0 0 * *", "*/0 * * * *", "5-1 * * * *",
+                           "0 0 * * funday"):
+            with self.subTest(expression=expression):
+                self.assertRaises(ValueError, vacap.CronSchedule, expression)
+
+    def test_next_after(self):
+        """The next fire time is exact, and always after when."""
+        when = datetime(2024, 1, 31, 10, 30, 20)  # a wednesday
+        for expression, expected in (
+                ("* * * * *", datetime(2024, 1, 31, 10, 31)),
+                ("30 10 * * *", datetime(2024, 2, 1, 10, 30)),
+                ("0 9 * * mon", datetime(2024, 2, 5, 9, 0)),
+                ("0 0 1 * *", datetime(2024, 2, 1, 0, 0)),
+                ("0 0 29 2 *", datetime(2024, 2, 29, 0, 0)),
+                ("0 12 31 * *", datetime(2024, 1, 31, 12, 0)),
+                ("0 0 30 * *", datetime(2024, 3, 30, 0, 0)),
+                ("0 0 13 * fri", datetime(2024, 2, 2, 0, 0)),
+                ("@hourly", datetime(2024, 1, 31, 11, 0))):
+            with self.subTest(expression=expression):
+                self.assertEqual(vacap.CronSchedule(expression).next_after(
+                    when), expected)
+
+    def test_never_matches(self):
+        """An impossible date raises ValueError instead of looping."""
+        self.assertRaises(ValueError, vacap.CronSchedule(
+            "0 0 31 2 *").next_after, datetime(2024, 1, 1))
+
+
+class TestScheduler(unittest.TestCase):
+
+    """Fire times of the scheduler, with its state on a temporary file."""
+
+    def setUp(self):
+        """Create the folder of the state file."""
+        self.folder = mkdtemp(prefix="vacap_test_")
+        self.state_filename = os.path.join(self.folder, "schedule.json")
+
+    def tearDown(self):
+        """Remove every file made by the test."""
+        shutil.rmtree(self.folder)
+
+    def test_bad_schedules_are_skipped(self):
+        """Invalid and never matching schedules do not stop the others."""
+        scheduler = vacap.Scheduler(
+            [{"cron": "0 0 31 2 *"}, {"cron": "not cron"}, {"origins": []},
+             "@daily", {"cron": "0 3 * * *", "origins": ["/home"]}],
+            state_filename=self.state_filename)
+        self.assertEqual([cron.expression for cron, _ in
+                          scheduler.schedules.values()], ["0 3 * * *"])
+        self.assertEqual(len(scheduler.fire_times), 1)
+
+    def test_pop_due(self):
+        """Due schedules are merged, fired once, then rescheduled."""
+        scheduler = vacap.Scheduler(
+            [{"cron": "* * * * *", "origins": ["/b"]},
+             {"cron": "* * * * *", "origins": ["/a"]},
+             {"cron": "0 0 1 1 *"}], catch_up=False,
+            state_filename=self.state_filename)
+        now = min(scheduler.fire_times.values())
+        self.assertEqual(scheduler.pop_due(now), (True, ["/a", "/b"]))
+        self.assertEqual(scheduler.pop_due(now), (False, []))
+        self.assertTrue(os.path.isfile(self.state_filename))
+        self.assertGreater(scheduler.seconds_to_next(now), 0)
+
+
+if __name__ in '__main__':
+    unittest.main()
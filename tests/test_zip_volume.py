@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Round trip tests of the ZIP volumes written by the pipeline."""
+
+
+# imports
+import os
+import random
+import shutil
+import sys
+import unittest
+import zipfile
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import vacap  # noqa: E402
+
+
+##############################################################################
+
+
+CODECS = ("store", "deflate", "bz2", "lzma") + (
+    ("zstd", ) if vacap.zstd else ())
+FILES = {
+    "empty.txt": b"",
+    "small.txt": b"hola mundo " * 1000,
+    "sub/text.txt": b"lorem ipsum dolor sit amet " * 200000,
+    "random.bin": random.Random(1).randbytes(3 * 1024 * 1024 + 17),
+    "photo.jpg": random.Random(2).randbytes(200000),
+}
+
+
+class TestZipVolume(unittest.TestCase):
+
+    """Write ZIP volumes of a small tree, then read them back."""
+
+    def setUp(self):
+        """Create the origin folder and the destination folder."""
+        self.folder = mkdtemp(prefix="vacap_test_")
+        self.origin = os.path.join(self.folder, "origin")
+        for relative, data in FILES.items():
+            path = os.path.join(self.origin, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as test_file:
+                test_file.write(data)
+        self.relatives = sorted(FILES)
+
+    def tearDown(self):
+        """Remove every file made by the test."""
+        shutil.rmtree(self.folder)
+
+    def get_options(self, **options):
+        """Return the default options, with a small pipeline memory."""
+        return dict(vacap.CONFIG_DEFAULTS, **dict({
+            "PIPELINE_MEMORY_MB": 4}, **options))
+
+    def get_manifest(self):
+        """Return a new full backup manifest of the origin folder."""
+        return {"origin": self.origin, "deleted": [], "type": "full",
+                "base": None}
+
+    def write_volumes(self, options, max_size=0, start=(0, 0)):
+        """Write volumes until every file is stored, return their data.
+
+        Returns {relative: Bytes} joining the pieces and the manifests,
+        the file resumed at start has its Bytes from that offset on.
+        """
+        data, manifests = {}, []
+        skipped = {self.relatives[start[0]]: start[1]}
+        while start[0] < len(self.relatives):
+            zip_filename = os.path.join(self.folder, "{}.zip".format(
+                len(manifests)))
+            manifest = self.get_manifest()
+            index, offset, checksum = vacap.write_zip_volume(
+                zip_filename, self.origin, self.relatives, manifest, start,
+                max_size, options=options)
+            self.assertEqual(checksum, vacap.hash_file(zip_filename))
+            self.assertFalse(os.path.exists(zip_filename + ".part"))
+            if max_size:
+                self.assertLessEqual(os.path.getsize(zip_filename), max_size)
+            with zipfile.ZipFile(zip_filename) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                for name in zip_file.namelist():
+                    if name == vacap.MANIFEST_FILENAME:
+                        continue
+                    piece = manifest["pieces"].get(name)
+                    stored = data.setdefault(name, bytearray())
+                    if piece:
+                        self.assertEqual(skipped.get(name, 0) + len(stored),
+                                         piece[0])
+                    stored += zip_file.read(name)
+            self.assertNotEqual((index, offset), start)
+            manifests.append(manifest)
+            start = (index, offset)
+        return data, manifests
+
+    def test_every_codec(self):
+        """Every codec stores every file, empty ones too, on 1 volume."""
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                data, manifests = self.write_volumes(self.get_options(
+                    COMPRESSION_FORMAT=codec))
+                self.assertEqual(len(manifests), 1)
+                self.assertEqual(manifests[0]["errors"], {})
+                for relative in self.relatives:
+                    self.assertEqual(bytes(data[relative]), FILES[relative])
+
+    def test_store_compressed_files(self):
+        """Already compressed files are stored, not compressed again."""
+        zip_filename = os.path.join(self.folder, "stored.zip")
+        vacap.write_zip_volume(zip_filename, self.origin, self.relatives,
+                               self.get_manifest(),
+                               options=self.get_options())
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            self.assertEqual(zip_file.getinfo("photo.jpg").compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(zip_file.getinfo("small.txt").compress_type,
+                             zipfile.ZIP_DEFLATED)
+
+    def test_split_pieces(self):
+        """Files bigger than the room left are split between volumes."""
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                data, manifests = self.write_volumes(self.get_options(
+                    COMPRESSION_FORMAT=codec, STORE_COMPRESSED_FILES=False),
+                    max_size=1024 * 1024)
+                self.assertGreater(len(manifests), 3)
+                self.assertTrue(any("random.bin" in manifest["pieces"]
+                                    for manifest in manifests))
+                for relative in self.relatives:
+                    self.assertEqual(bytes(data[relative]), FILES[relative])
+
+    def test_split_file_is_read_once(self):
+        """The rest of a file that does not fit is not read ahead."""
+        read_block, read = vacap.read_block, []
+
+        def counted_read_block(*args, **kwargs):
+            data = read_block(*args, **kwargs)
+            read.append(len(data))
+            return data
+
+        vacap.read_block = counted_read_block
+        try:
+            self.write_volumes(self.get_options(
+                COMPRESSION_FORMAT="store", PIPELINE_MEMORY_MB=64),
+                max_size=1024 * 1024)
+        finally:
+            vacap.read_block = read_block
+        self.assertLess(sum(read), sum(map(len, FILES.values())) * 1.5)
+
+    def test_resume(self):
+        """Resuming at (index, offset) stores the rest of that file on."""
+        index = self.relatives.index("random.bin")
+        offset = 1024 * 1024 + 5
+        data, manifests = self.write_volumes(self.get_options(),
+                                             start=(index, offset))
+        self.assertEqual(manifests[0]["pieces"]["random.bin"], [
+            offset, len(FILES["random.bin"]) - offset,
+            len(FILES["random.bin"])])
+        self.assertEqual(bytes(data["random.bin"]),
+                         FILES["random.bin"][offset:])
+        self.assertEqual(sorted(data), self.relatives[index:])
+
+    def test_changed_file_is_an_error(self):
+        """A file that grew since the scan is counted, listed, not stored."""
+        state = {relative: [len(FILES[relative]), int(os.path.getmtime(
+            os.path.join(self.origin, *relative.split("/")))), None]
+            for relative in self.relatives}
+        state["small.txt"][0] -= 10
+        manifest, report = self.get_manifest(), vacap.RunReport()
+        zip_filename = os.path.join(self.folder, "changed.zip")
+        vacap.write_zip_volume(zip_filename, self.origin, self.relatives,
+                               manifest, options=self.get_options(),
+                               report=report, state=state)
+        self.assertEqual(list(manifest["errors"]), ["small.txt"])
+        self.assertEqual(report.counters["errors"], 1)
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertNotIn("small.txt", zip_file.namelist())
+            self.assertIn("sub/text.txt", zip_file.namelist())
+
+
+if __name__ in '__main__':
+    unittest.main()
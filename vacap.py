@@ -6,27 +6,55 @@
 
 
 # imports
+import argparse
+import bz2
+import cProfile
 import ctypes
+import fnmatch
+import hashlib
+import heapq
 import logging as log
+import lzma
 import os
+import platform
+import random
+import re
 import shutil
 import signal
+import sqlite3
+import struct
 import sys
+import threading
 import time
-from calendar import day_name
+import tracemalloc
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from contextlib import ExitStack, contextmanager
 from ctypes import wintypes
-from datetime import datetime
+from datetime import datetime, timedelta
 from getpass import getuser
-from hashlib import sha1
 from json import dumps, loads
-from stat import S_IREAD
+from logging.handlers import RotatingFileHandler
+from multiprocessing import Manager
+from queue import Empty, Queue
+from stat import S_IREAD, S_IWRITE
 from tempfile import gettempdir
 
-from PyQt5.QtCore import Qt, QTimer
-from PyQt5.QtGui import QCursor, QFont, QIcon
-from PyQt5.QtWidgets import (QApplication, QFileDialog, QInputDialog, QMenu,
-                             QMessageBox, QProgressDialog, QStyle,
-                             QSystemTrayIcon)
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # Linux, Mac
+    msvcrt = None
 
 
 ##############################################################################
@@ -43,6 +71,57 @@ from PyQt5.QtWidgets import (QApplication, QFileDialog, QInputDialog, QMenu,
 # MAKE_BACKUP_ONLY_ON_WEEKENDS si es True hace Backup solo Sabados y Domingos.
 # MAKE_BACKUP_ONLY_ON_WEEKENDS si es False hace Backups solo los dias de semana
 #   que son Lunes, Martes, Miercoles, Jueves y Viernes unicamente.
+# MAKE_INCREMENTAL_BACKUPS si es True solo guarda archivos nuevos o cambiados.
+# MAKE_FULL_BACKUP_EVERY hace 1 Backup completo cada tantos Backups.
+# INCREMENTAL_HASH_CONTENT si es True compara el contenido de los archivos.
+# MAX_WORKERS cuantos procesos comprimen carpetas a la vez, 0 es automatico.
+# IO_PRIORITY prioridad de los procesos que comprimen: idle, low, normal.
+# READ_LIMIT_MB_S maximo de MegaBytes por segundo leidos, 0 es sin limite.
+# WRITE_LIMIT_MB_S maximo de MegaBytes por segundo escritos, 0 es sin limite.
+# BACKOFF_MAX_LOAD si la carga de CPU de otros programas (por CPU) supera
+#   este valor el Backup hace una pausa hasta que baje, 0 deshabilita.
+# BACKOFF_MAX_DISK_QUEUE si la cola del disco supera este valor el Backup
+#   hace una pausa hasta que baje, 0 deshabilita.
+# BACKOFF_MAX_PAUSE_SECONDS pausa maxima seguida, luego sigue igual.
+# REPOSITORY_MODE como guardar los Backups: zip (1 ZIP por carpeta) o dedup
+#   (repositorio deduplicado, cada pedazo de archivo se guarda 1 sola vez).
+# DEDUP_KEEP_SNAPSHOTS en modo dedup cuantos Backups guardar, 0 guarda todos.
+# DEDUP_FIXED_CHUNKS_OVER_MB en modo dedup los archivos mas grandes que
+#   tantos MegaBytes (y los ya comprimidos) se parten en pedazos fijos, mas
+#   rapido pero deduplica menos si se inserta algo en el medio, 0 nunca.
+# COMPRESSION_FORMAT como comprimir: store, deflate, bz2, lzma, zstd.
+# COMPRESSION_LEVEL nivel de compresion, null usa el nivel por defecto.
+# STORE_COMPRESSED_FILES si es True no recomprime Fotos, Videos, ZIP, etc.
+# SCHEDULES lista de horarios tipo cron, cada uno {"cron": "0 12 * * fri"}
+#   y opcional "origins" con sus propias carpetas, si esta vacia se usan
+#   MAKE_BACKUP_AT_THIS_HOUR y MAKE_BACKUP_ON_WEEK_DAY.
+# SCHEDULE_CATCH_UP si es True hace los Backups perdidos (compu apagada).
+# SCHEDULE_JITTER_SECONDS demora al azar maxima, para no saturar el NAS.
+# EXCLUDE_PATTERNS lista de patrones estilo .gitignore que nunca se copian,
+#   "*.tmp" en cualquier carpeta, "/build/" solo en la raiz, "!" re-incluye.
+# ORIGIN_RULES reglas por carpeta de origen, por ejemplo
+#   {"C:\\Proyectos": {"exclude": ["node_modules/", ".git/"],
+#    "include": ["*.py"], "min_size": 0, "max_size": 0, "max_age_days": 0}}
+#   tamaños en Bytes, 0 es sin limite.
+# SCAN_THREADS cuantos hilos leen carpetas a la vez, 0 es automatico.
+# SEGMENT_SIZE_MB cada cuantos MegaBytes de origen se cierra 1 ZIP parcial,
+#   si se corta la luz el Backup sigue desde el ultimo ZIP parcial, 0 es 1 ZIP.
+# MAX_VOLUME_SIZE_MB tamaño maximo de cada ZIP en MegaBytes, los archivos
+#   mas grandes se parten en pedazos entre ZIPs, 0 es sin limite.
+# COPY_VOLUMES_TO lista de carpetas (Pendrive, Disco Externo) donde se copia
+#   cada ZIP apenas termina, en la primera que tenga lugar.
+# PIPELINE_MEMORY_MB memoria maxima de cada proceso para archivos leidos y
+#   comprimidos por adelantado, mientras se escribe el ZIP.
+# PIPELINE_THREADS cuantos hilos comprimen cada ZIP a la vez, 0 es automatico.
+# KEEP_LAST antes de cada Backup borra los viejos, guarda los ultimos tantos.
+# KEEP_DAILY guarda el ultimo Backup de cada uno de los ultimos tantos dias.
+# KEEP_WEEKLY guarda el ultimo Backup de cada una de las ultimas semanas.
+# KEEP_MONTHLY guarda el ultimo Backup de cada uno de los ultimos meses.
+#   Si todos son 0 no se borra nada, los incrementales guardan su completo.
+# MAX_TOTAL_SIZE_MB borra los Backups mas viejos mientras el total supere
+#   tantos MegaBytes, siempre queda el ultimo, 0 es sin limite.
+# PROFILE_RUN si es True guarda perfiles de cProfile y tracemalloc en /tmp.
+# CHECKSUM_ALGORITHM algoritmo para el Checksum del ZIP: sha1, sha256, blake2b.
 
 
 # metadata
@@ -56,14 +135,120 @@ __url__ = ''
 
 config = None
 CONFIG_FILENAME = os.path.join(os.path.expanduser("~"), "vacap_config.json")
-CSS_STYLE = """
-    QMenu, QProgressDialog {
-        background-color: qlineargradient(
-            spread: reflect, x1: 0.5, y1: 0.5, x2: 0, y2: 0,
-            stop: 0 lightcyan, stop: 1 limegreen, stop: 1 skyblue);
-        border-left: 9px solid lightgreen;
-    }
+SCHEDULE_FILENAME = os.path.join(os.path.expanduser("~"),
+                                 "vacap_schedule.json")
+SCHEDULE_MAX_SLEEP = 300  # re-check wall clock, timers may stop on suspend
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_NAMES = dict(
+    [(name, number) for number, name in enumerate((
+        "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct",
+        "nov", "dec"), 1)] +
+    [(name, number) for number, name in enumerate((
+        "sun", "mon", "tue", "wed", "thu", "fri", "sat"))])
+CRON_MACROS = {"@hourly": "0 * * * *", "@daily": "0 0 * * *",
+               "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *"}
+WEEK_DAYS = {"domingo": 0, "lunes": 1, "martes": 2, "miercoles": 3,
+             "jueves": 4, "viernes": 5, "sabado": 6}  # cron numbers
+CONFIG_DEFAULTS = {
+    "BACKOFF_MAX_DISK_QUEUE": 4,
+    "BACKOFF_MAX_LOAD": 0.9,
+    "BACKOFF_MAX_PAUSE_SECONDS": 600,
+    "CHECKSUM_ALGORITHM": "sha1",
+    "COMPRESSION_FORMAT": "deflate",
+    "COMPRESSION_LEVEL": None,
+    "COPY_VOLUMES_TO": [],
+    "DEDUP_FIXED_CHUNKS_OVER_MB": 64,
+    "DEDUP_KEEP_SNAPSHOTS": 0,
+    "EXCLUDE_PATTERNS": ["*.tmp", "~$*", "Thumbs.db", "desktop.ini"],
+    "INCREMENTAL_HASH_CONTENT": False,
+    "IO_PRIORITY": "low",
+    "KEEP_DAILY": 0,
+    "KEEP_LAST": 0,
+    "KEEP_MONTHLY": 0,
+    "KEEP_WEEKLY": 0,
+    "MAKE_FULL_BACKUP_EVERY": 7,
+    "MAKE_INCREMENTAL_BACKUPS": False,
+    "MAX_TOTAL_SIZE_MB": 0,
+    "MAX_VOLUME_SIZE_MB": 0,
+    "MAX_WORKERS": 0,
+    "ORIGIN_RULES": {},
+    "PIPELINE_MEMORY_MB": 64,
+    "PIPELINE_THREADS": 0,
+    "PROFILE_RUN": False,
+    "READ_LIMIT_MB_S": 0,
+    "REPOSITORY_MODE": "zip",
+    "SCAN_THREADS": 0,
+    "SCHEDULES": [],
+    "SEGMENT_SIZE_MB": 1024,
+    "SCHEDULE_CATCH_UP": True,
+    "SCHEDULE_JITTER_SECONDS": 0,
+    "STORE_COMPRESSED_FILES": True,
+    "WRITE_LIMIT_MB_S": 0,
+}
+CHECKSUM_ALGORITHMS = ("sha1", "sha256", "blake2b")
+CHECKSUM_CHUNK_SIZE = 1024 * 1024  # 1 MegaByte per read, constant memory.
+INDEX_FILENAME = "vacap_index.json"
+CATALOG_FILENAME = "vacap_catalog.sqlite3"  # every file of every ZIP
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    snapshot TEXT NOT NULL, origin TEXT NOT NULL, path TEXT NOT NULL,
+    size INTEGER, mtime INTEGER, crc INTEGER, hash TEXT,
+    archive TEXT NOT NULL, header_offset INTEGER, compress_type INTEGER,
+    compress_size INTEGER, piece_offset INTEGER, piece_size INTEGER);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_archive ON files (snapshot, archive);
+CREATE TABLE IF NOT EXISTS archives (
+    snapshot TEXT NOT NULL, origin TEXT NOT NULL, archive TEXT NOT NULL,
+    type TEXT, base TEXT, size INTEGER, PRIMARY KEY (snapshot, archive));
+CREATE TABLE IF NOT EXISTS deleted (
+    snapshot TEXT NOT NULL, origin TEXT NOT NULL, path TEXT NOT NULL,
+    archive TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS deleted_path ON deleted (path);
+CREATE TABLE IF NOT EXISTS errors (
+    snapshot TEXT NOT NULL, origin TEXT NOT NULL, path TEXT NOT NULL,
+    archive TEXT NOT NULL, reason TEXT);
+CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY);
 """
+CATALOG_VERSION = 2  # older lack deleted or errors, snapshots are read again
+LOCAL_HEADER = struct.Struct("<4s5H3I2H")  # ZIP local file header
+JOURNAL_FILENAME = "vacap_journal.json"  # snapshot and origins of a run
+SEGMENT_JOURNAL = ".journal"  # appended to ZIP filename, 1 line per segment
+WORST_CASE_RATIO = 1.02  # raw LZMA grows random data ~1.4%, others less
+ZIP_ENTRY_OVERHEAD = 256  # local header, central directory, zip64 extras
+MIN_PIECE_SIZE = 64 * 1024  # smaller room starts a new volume instead
+PIPELINE_READERS = 2  # prefetch threads, more only thrash spinning disks
+DATA_DESCRIPTOR = 0x08  # ZIP flag, CRC and sizes are written after the data
+MANIFEST_FILENAME = ".vacap_manifest.json"
+SNAPSHOT_FORMAT = "%Y-%m-%dt%H_%M_%S"  # same as check_destination_folder.
+REPOSITORY_FOLDER = "vacap_repository"
+REPORT_FILENAME = "vacap_report.ndjson"  # 1 JSON line per backup run
+SLOWEST_FILES_COUNT = 10
+BACKOFF_CHECK_SECONDS = 2  # how often to look at load, disk queue, battery
+IOPRIO_SET = {"x86_64": 251, "amd64": 251, "aarch64": 30, "i386": 289,
+              "i686": 289}  # Linux ioprio_set syscall numbers
+CHUNK_MIN_SIZE = 512 * 1024  # Content-Defined Chunking sizes, average ~1 MB.
+CHUNK_MASK = (1 << 19) - 1  # cut when hash & mask == 0, after CHUNK_MIN_SIZE
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+FIXED_CHUNK_SIZE = 1024 * 1024  # big or compressed files skip the hashing
+LOCK_FILENAME = "vacap.lock"  # held by backup, prune and gc
+CHUNK_HEADER = struct.Struct("<32sBI")  # sha256 digest, codec, data length
+CHUNK_CODECS = ("store", "deflate", "bz2", "lzma", "zstd")  # codec byte
+ZIP_CODECS = {
+    "store": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED,
+    "bz2": zipfile.ZIP_BZIP2, "lzma": zipfile.ZIP_LZMA,
+    "zstd": getattr(zipfile, "ZIP_ZSTANDARD", None),  # Python 3.14+
+}
+COMPRESSED_EXTENSIONS = frozenset((
+    "7z", "aac", "apk", "avi", "bz2", "cab", "docx", "epub", "flac", "flv",
+    "gif", "gz", "heic", "jar", "jpeg", "jpg", "lz", "lzma", "m4a", "m4v",
+    "mkv", "mov", "mp3", "mp4", "mpeg", "mpg", "odp", "ods", "odt", "ogg",
+    "opus", "png", "pptx", "rar", "tgz", "webm", "webp", "wma", "wmv", "xlsx",
+    "xz", "zip", "zst"))
+ENTROPY_SAMPLE_SIZE = 64 * 1024  # sample to guess if a file is compressible
+PACK_MAX_SIZE = 64 * 1024 * 1024
+# Gear table for the rolling hash, derived so it never changes between runs.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little")
+        for i in range(256)]
 
 
 class SYSTEM_POWER_STATUS(ctypes.Structure):
@@ -79,6 +264,8 @@ class SYSTEM_POWER_STATUS(ctypes.Structure):
 
 def windows_is_running_on_battery():
     """Try to find out if MS Windows is running on battery."""
+    if not sys.platform.startswith("win"):
+        return False
     SYSTEM_POWER_STATUS_P = ctypes.POINTER(SYSTEM_POWER_STATUS)
     GetSystemPowerStatus = ctypes.windll.kernel32.GetSystemPowerStatus
     GetSystemPowerStatus.argtypes = [SYSTEM_POWER_STATUS_P]
@@ -90,71 +277,2028 @@ def windows_is_running_on_battery():
     return not bool(status.ACLineStatus)  # ACLineStatus = 1 is AC
 
 
-def get_or_set_config():
-    """Get config if exist else Set config if not exist."""
+def get_or_set_config(ask_config=None):
+    """Get config if exist else Set config if not exist.
+
+    ask_config is a callable asking the user for a new config dict (the GUI
+    wizard), returning None if not confirmed. Without it a missing config is
+    an error, headless runs can not ask anything.
+    """
     global config
     log.debug("Vacap Config File: {}.".format(CONFIG_FILENAME))
-    days = ["Lunes", "Martes", "Miercoles",
-            "Jueves", "Viernes", "Sabado", "Domingo"]
     # if config does not exist or cant be read then try to create it, ask user.
     if not os.path.isfile(CONFIG_FILENAME):
+        if ask_config is None:
+            raise FileNotFoundError(
+                "Vacap Config File {} does not exist, run 'vacap tray' to "
+                "create it.".format(CONFIG_FILENAME))
         log.warning("Vacap Config File does not exist; Will try to create it.")
-        QMessageBox.information(None, __doc__, "<b>Vamos a Configurar Vacap!.")
-        msg = "<b>Hacer un Backup Copia de Seguridad al Iniciar la compu ?."
-        _st = QMessageBox.question(
-            None, __doc__, msg, QMessageBox.Yes | QMessageBox.No,
-            QMessageBox.No) == QMessageBox.Yes
-        msg = "<b>Hacer Backup Copia de Seguridad si la compu esta a Bateria ?"
-        _bt = QMessageBox.question(
-            None, __doc__, msg, QMessageBox.Yes | QMessageBox.No,
-            QMessageBox.Yes) == QMessageBox.Yes
-        msg = "<b>Que Dia de la Semana Hacer Backup Copia de Seguridad ?."
-        _day = str(QInputDialog.getItem(
-            None, __doc__, msg, days, 4, False)[0]).lower()
-        msg = "<b>A que Hora del Dia hacer Hacer Backup Copia de Seguridad ?."
-        _hour = int(QInputDialog.getInt(None, __doc__, msg, 12, 1, 23)[0])
-        msg = "<b>Donde Guardar el Backup Copia de Seguridad ?."
-        QMessageBox.information(None, __doc__, msg)
-        _trg = QFileDialog.getExistingDirectory(None, __doc__, gettempdir())
-        msg = "<b>Agregar 1 Carpeta para hacer Backup Copia de Seguridad ?."
-        _backup_from = []
-        while QMessageBox.question(
-            None, __doc__, msg, QMessageBox.Yes | QMessageBox.No,
-                QMessageBox.Yes) == QMessageBox.Yes:
-            _backup_from.append(str(QFileDialog.getExistingDirectory(
-                None, __doc__, os.path.expanduser("~"))))
-        configura = {
-            "MAKE_BACKUP_FROM": _backup_from,
-            "SAVE_BACKUP_TO": _trg,
-            "MAKE_BACKUP_ON_STARTUP": _st,
-            "MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY": _bt,
-            "MAKE_BACKUP_ON_WEEK_DAY": _day,
-            "MAKE_BACKUP_AT_THIS_HOUR": _hour,
-        }
-        config = dumps(configura, ensure_ascii=False, indent=4, sort_keys=True)
-        log.debug("Configuration: {}.".format(config))
-        confirm = QInputDialog.getMultiLineText(
-            None, __doc__, "<b>Resumen Final de la Configuracion:", config)[1]
-        if confirm:
-            with open(CONFIG_FILENAME, "w", encoding="utf-8") as _config:
-                _config.write(config)
-            try:
-                log.info("Making Config {} Hidden".format(CONFIG_FILENAME))
-                ctypes.windll.kernel32.SetFileAttributesW(CONFIG_FILENAME,
-                                                          0x02)  # hidden file
-                log.info("Making Config {} ReadOnly.".format(CONFIG_FILENAME))
-                os.chmod(CONFIG_FILENAME, S_IREAD)  # make read-only
-            except Exception as reason:
-                log.critical(reason)
-        else:
-            return get_or_set_config()
+        configura = ask_config()
+        if configura is None:
+            return get_or_set_config(ask_config)
+        config = dict(CONFIG_DEFAULTS, **configura)
+        with open(CONFIG_FILENAME, "w", encoding="utf-8") as _config:
+            _config.write(dumps(config, ensure_ascii=False, indent=4,
+                                sort_keys=True))
+        try:
+            log.info("Making Config {} Hidden".format(CONFIG_FILENAME))
+            ctypes.windll.kernel32.SetFileAttributesW(CONFIG_FILENAME,
+                                                      0x02)  # hidden file
+            log.info("Making Config {} ReadOnly.".format(CONFIG_FILENAME))
+            os.chmod(CONFIG_FILENAME, S_IREAD)  # make read-only
+        except Exception as reason:
+            log.critical(reason)
     else:
         log.debug("Reading/Parsing Config File: {}.".format(CONFIG_FILENAME))
         with open(CONFIG_FILENAME, "r", encoding="utf-8") as _config:
-            config = loads(_config.read())
+            config = dict(CONFIG_DEFAULTS, **loads(_config.read()))
     return config
 
 
+class RunReport(object):
+
+    """Stage timings and counters of a backup run, saved as NDJSON lines.
+
+    Worker processes fill their own RunReport and return it, the main
+    process merges them into the report of the whole run.
+    """
+
+    def __init__(self, **info):
+        """Init class."""
+        self.info, self.origins = info, {}
+        self.stages, self.counters, self.slowest = {}, {}, []
+        self.started, self.clock, self.seconds = (
+            time.time(), time.perf_counter(), None)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager adding the time spent inside to stage name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + (
+                time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        """Add value to counter name."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_file(self, path, seconds, size_in, size_out):
+        """Count 1 archived file, keeping only the slowest ones."""
+        self.count("files")
+        self.count("bytes_in", size_in)
+        self.count("bytes_out", size_out)
+        self.keep_slowest((round(seconds, 4), size_in, path))
+
+    def keep_slowest(self, item):
+        """Keep item of (seconds, size, path) if it is one of the slowest."""
+        if len(self.slowest) < SLOWEST_FILES_COUNT:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def stop(self):
+        """Freeze the elapsed seconds, workers call it before returning."""
+        self.seconds = time.perf_counter() - self.clock
+
+    def merge(self, origin, other):
+        """Merge the RunReport of a worker that archived origin."""
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0) + seconds
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for seconds, size, path in other.slowest:
+            self.keep_slowest((seconds, size, os.path.join(origin, path)))
+        self.origins[origin] = {
+            "seconds": round(other.seconds if other.seconds is not None else
+                             time.time() - other.started, 4),
+            "stages": {name: round(seconds, 4)
+                       for name, seconds in other.stages.items()},
+            "counters": other.counters,
+            "compression_ratio": round(other.counters.get("bytes_out", 0) / (
+                other.counters.get("bytes_in", 0) or 1), 4)}
+
+    def to_dict(self):
+        """Return the report as a JSON serializable dict."""
+        return dict(self.info, **{
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "seconds": round(time.time() - self.started, 4),
+            "stages": {name: round(seconds, 4)
+                       for name, seconds in self.stages.items()},
+            "counters": self.counters, "origins": self.origins,
+            "compression_ratio": round(self.counters.get("bytes_out", 0) / (
+                self.counters.get("bytes_in", 0) or 1), 4),
+            "slowest_files": sorted(self.slowest, reverse=True)})
+
+    def save(self, filename):
+        """Append the report as 1 JSON line to filename."""
+        with open(filename, "a", encoding="utf-8") as report_file:
+            report_file.write(dumps(self.to_dict(), sort_keys=True) + "\n")
+        log.info("Saved Run Report to {}.".format(filename))
+
+
+def profiled_call(profile_filename, function, *args):
+    """Run function(*args) under cProfile, dump stats to profile_filename."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profile_filename)
+        log.info("Saved Profile to {}.".format(profile_filename))
+
+
+def get_checksum_algorithm(options=None):
+    """Return the configured checksum algorithm name, fallback to SHA1."""
+    algorithm = str((options or config or {}).get("CHECKSUM_ALGORITHM",
+                                                  "sha1")).lower()
+    if algorithm not in CHECKSUM_ALGORITHMS or (
+            algorithm not in hashlib.algorithms_available):
+        log.warning("Checksum {} not available, using SHA1.".format(algorithm))
+        algorithm = "sha1"
+    return algorithm
+
+
+def hash_file(filename, algorithm="sha1", chunk_size=CHECKSUM_CHUNK_SIZE,
+              throttle=None):
+    """Return hex digest of filename, reading it in fixed-size chunks."""
+    checksum = hashlib.new(algorithm)
+    with open(filename, "rb") as file_to_hash:
+        for chunk in iter(lambda: file_to_hash.read(chunk_size), b""):
+            if throttle:
+                throttle.read(len(chunk))
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def load_index(folder):
+    """Load the persistent file-state index stored on folder, if any."""
+    index_file = os.path.join(folder, INDEX_FILENAME)
+    if not os.path.isfile(index_file):
+        return {"origins": {}}
+    try:
+        with open(index_file, "r", encoding="utf-8") as _index:
+            return loads(_index.read())
+    except Exception as reason:
+        log.critical("Index {} is corrupt, ignoring it: {}.".format(
+            index_file, reason))
+        return {"origins": {}}
+
+
+def save_json(filename, data):
+    """Save data as JSON on filename, atomically replacing old one."""
+    with open(filename + ".tmp", "w", encoding="utf-8") as _json:
+        _json.write(dumps(data, ensure_ascii=False, sort_keys=True))
+    os.replace(filename + ".tmp", filename)
+
+
+def fsync_file(filename):
+    """Flush filename to disk, before renaming it to its final name."""
+    with open(filename, "r+b") as _file:
+        os.fsync(_file.fileno())
+
+
+def fsync_folder(folder):
+    """Flush the entries of folder to disk, so a rename survives a crash.
+
+    Windows can not open folders and NTFS journals the renames anyway.
+    """
+    if os.name == "nt":
+        return
+    folder_descriptor = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(folder_descriptor)
+    finally:
+        os.close(folder_descriptor)
+
+
+def save_index(folder, index):
+    """Save the file-state index on folder, atomically replacing old one."""
+    index_file = os.path.join(folder, INDEX_FILENAME)
+    save_json(index_file, index)
+    log.debug("Saved Index {}.".format(index_file))
+
+
+class PathRules(object):
+
+    """Gitignore style exclude and include patterns, plus size and age limits.
+
+    Patterns without a slash match a name at any depth, patterns with a
+    slash are anchored to the origin folder, a trailing slash only matches
+    folders, ** matches any depth and ! re-includes, the last match wins.
+    """
+
+    def __init__(self, exclude=(), include=(), min_size=0, max_size=0,
+                 max_age_days=0):
+        """Init class."""
+        self.exclude = [self.compile(pattern) for pattern in exclude
+                        if pattern.strip() and not pattern.startswith("#")]
+        self.include = [self.compile(pattern) for pattern in include
+                        if pattern.strip() and not pattern.startswith("#")]
+        self.min_size, self.max_size = int(min_size), int(max_size)
+        self.max_age = float(max_age_days) * 86400
+
+    @staticmethod
+    def compile(pattern):
+        """Compile 1 pattern to (regex, negated, only_folders)."""
+        pattern = pattern.strip()
+        negated = pattern.startswith("!")
+        pattern = pattern[1:] if negated else pattern
+        only_folders = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        regex = "" if "/" in pattern else "(?:.*/)?"  # slash means anchored
+        pattern, position = pattern.lstrip("/"), 0
+        while position < len(pattern):
+            if pattern.startswith("**/", position):
+                regex, position = regex + "(?:.*/)?", position + 3
+            elif pattern.startswith("**", position):
+                regex, position = regex + ".*", position + 2
+            elif pattern[position] == "*":
+                regex, position = regex + "[^/]*", position + 1
+            elif pattern[position] == "?":
+                regex, position = regex + "[^/]", position + 1
+            elif pattern[position] == "[" and "]" in pattern[position + 2:]:
+                end = pattern.index("]", position + 2)
+                klass = pattern[position + 1:end].replace("\\", "\\\\")
+                regex += "[{}]".format("^" + klass[1:] if klass.startswith(
+                    "!") else klass)
+                position = end + 1
+            else:
+                regex += re.escape(pattern[position])
+                position += 1
+        flags = re.IGNORECASE if sys.platform.startswith("win") else 0
+        regex = re.compile(regex + r"(/)?(?(1).*)\Z", flags)  # or descendant
+        return regex, negated, only_folders
+
+    @staticmethod
+    def matches(rule, relative, is_folder):
+        """Return True if rule matches relative path or any of its parents."""
+        match = rule[0].match(relative)
+        return bool(match) and (is_folder or not rule[2] or bool(
+            match.group(1)))
+
+    def is_excluded(self, relative, is_folder=False):
+        """Return True if relative path is excluded, last matching wins."""
+        excluded = False
+        for rule in self.exclude:
+            if self.matches(rule, relative, is_folder):
+                excluded = not rule[1]
+        return excluded
+
+    def is_wanted(self, relative, stat, now):
+        """Return True if a file passes patterns, size and age filters."""
+        if self.is_excluded(relative):
+            return False
+        if self.include and not any(self.matches(rule, relative, False)
+                                    for rule in self.include):
+            return False
+        if stat.st_size < self.min_size or (
+                self.max_size and stat.st_size > self.max_size):
+            return False
+        return not self.max_age or now - stat.st_mtime <= self.max_age
+
+
+def get_path_rules(options, origin):
+    """Return PathRules for origin folder from options, None if no rules."""
+    origin = os.path.normcase(os.path.abspath(origin))
+    rules = {}
+    for folder, folder_rules in (options.get("ORIGIN_RULES") or {}).items():
+        if os.path.normcase(os.path.abspath(folder)) == origin:
+            rules = folder_rules
+    exclude = list(options.get("EXCLUDE_PATTERNS") or ()) + list(
+        rules.get("exclude", ()))
+    if not (exclude or rules):
+        return None
+    return PathRules(exclude, rules.get("include", ()),
+                     rules.get("min_size", 0), rules.get("max_size", 0),
+                     rules.get("max_age_days", 0))
+
+
+def scan_directory(folder, relative, rules=None, now=0):
+    """Scan 1 directory, return (files, subfolders) relative to folder.
+
+    Files are (relative_path, size, mtime), stat comes from os.scandir so on
+    MS Windows it costs no extra system call, excluded folders are pruned.
+    """
+    files, folders = [], []
+    try:
+        with os.scandir(os.path.join(folder, *relative.split("/"))
+                        if relative else folder) as entries:
+            for entry in entries:
+                path = relative + "/" + entry.name if relative else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if rules is None or not rules.is_excluded(path, True):
+                            folders.append(path)
+                        continue
+                    if not entry.is_file():  # sockets, pipes, broken links
+                        continue
+                    stat = entry.stat()
+                except OSError as reason:
+                    log.warning(reason)
+                    continue
+                if rules is None or rules.is_wanted(path, stat, now):
+                    files.append((path, stat.st_size, int(stat.st_mtime)))
+    except OSError as reason:  # folder vanished or access denied
+        log.warning(reason)
+    return files, folders
+
+
+def scan_tree(folder, rules=None, threads=0):
+    """Yield (relative_path, size, mtime) for every wanted file on folder.
+
+    Directories are scanned in parallel on a thread pool, os.scandir releases
+    the GIL while waiting the disk, so many directories are read at once;
+    few threads by default, on a warm disk cache they only fight for the GIL.
+    """
+    threads = int(threads) or min(8, (os.cpu_count() or 1) * 2)
+    now = time.time()
+    if threads == 1:
+        pending = [""]
+        while pending:
+            files, folders = scan_directory(folder, pending.pop(), rules, now)
+            pending.extend(folders)
+            yield from files
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        pending = {executor.submit(scan_directory, folder, "", rules, now)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                pending.update(executor.submit(scan_directory, folder,
+                                               subfolder, rules, now)
+                               for subfolder in folders)
+                yield from files
+
+
+def load_journal(folder):
+    """Load the journal of an interrupted backup run on folder, if any."""
+    journal_file = os.path.join(folder, JOURNAL_FILENAME)
+    if not os.path.isfile(journal_file):
+        return {}
+    try:
+        with open(journal_file, "r", encoding="utf-8") as _journal:
+            return loads(_journal.read())
+    except ValueError as reason:
+        log.warning(reason)
+        return {}
+
+
+def append_json_line(filename, data):
+    """Append data as 1 JSON line to filename, flushed to disk."""
+    with open(filename, "a", encoding="utf-8") as _json:
+        _json.write(dumps(data, ensure_ascii=False, sort_keys=True) + "\n")
+        _json.flush()
+        os.fsync(_json.fileno())
+
+
+def read_json_lines(filename):
+    """Return the list of JSON lines of filename, ignoring a torn last line."""
+    lines = []
+    if os.path.isfile(filename):
+        with open(filename, "r", encoding="utf-8") as _json:
+            for line in _json:
+                try:
+                    lines.append(loads(line))
+                except ValueError:  # crashed while appending it
+                    break
+    return lines
+
+
+def scan_folder_state(folder, previous=None, hash_content=False, rules=None,
+                      threads=0):
+    """Return {relative_path: [size, mtime, hash]} for every file on folder.
+
+    Content hash is only computed when size or mtime changed, so unchanged
+    files are never read again; touched but identical files keep their hash.
+    """
+    previous, state = previous or {}, {}
+    for relative, size, mtime in scan_tree(folder, rules, threads):
+        old = previous.get(relative)
+        if old and old[0] == size and old[1] == mtime:
+            state[relative] = old
+        elif hash_content:
+            state[relative] = [size, mtime, hash_file(
+                os.path.join(folder, *relative.split("/")), "sha1")]
+        else:
+            state[relative] = [size, mtime, None]
+    return state
+
+
+def diff_folder_state(previous, current):
+    """Return (changed, deleted) relative paths between 2 folder states."""
+    changed = []
+    for relative, (size, mtime, checksum) in current.items():
+        old = previous.get(relative)
+        if old is None or (old[:2] != [size, mtime] and (
+                checksum is None or old[2] != checksum)):
+            changed.append(relative)
+    deleted = [relative for relative in previous if relative not in current]
+    return sorted(changed), sorted(deleted)
+
+
+def get_compression(options):
+    """Return (format, level) from options, fallback to deflate if missing."""
+    compression = str(options.get("COMPRESSION_FORMAT") or "deflate").lower()
+    compression = "lzma" if compression == "xz" else compression
+    if compression not in CHUNK_CODECS or (
+            compression == "zstd" and (zstd is None or ZIP_CODECS["zstd"] is
+                                       None)):
+        log.warning("Compression {} not available, using deflate.".format(
+            compression))
+        compression = "deflate"
+    return compression, options.get("COMPRESSION_LEVEL")
+
+
+def is_already_compressed(path, size):
+    """Guess if compressing path is a waste of CPU, by extension or entropy.
+
+    Unknown extensions compress a small sample with the fastest zlib level,
+    if it does not shrink at least 10% the file is considered incompressible.
+    """
+    if os.path.splitext(path)[1][1:].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if size < ENTROPY_SAMPLE_SIZE:
+        return False  # small files are cheap to compress anyway
+    try:
+        with open(path, "rb") as file_to_sample:
+            sample = file_to_sample.read(ENTROPY_SAMPLE_SIZE)
+    except OSError:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * 0.9
+
+
+def compress_chunk(chunk, compression, level=None):
+    """Compress chunk, return (data, codec byte), stored if it not shrinks."""
+    if compression == "deflate":
+        data = zlib.compress(chunk, 6 if level is None else level)
+    elif compression == "bz2":
+        data = bz2.compress(chunk, 9 if level is None else level)
+    elif compression == "lzma":
+        data = lzma.compress(chunk, preset=level)
+    elif compression == "zstd":
+        data = zstd.compress(chunk, level)
+    else:
+        data = chunk
+    if len(data) >= len(chunk):  # incompressible, store it as is
+        return chunk, 0
+    return data, CHUNK_CODECS.index(compression)
+
+
+def decompress_chunk(data, codec):
+    """Decompress data of a chunk stored with codec byte."""
+    compression = CHUNK_CODECS[codec]
+    if compression == "deflate":
+        return zlib.decompress(data)
+    elif compression == "bz2":
+        return bz2.decompress(data)
+    elif compression == "lzma":
+        return lzma.decompress(data)
+    elif compression == "zstd":
+        return zstd.decompress(data)
+    return data
+
+
+def get_worst_case_size(size, name, compress_type=None):
+    """Return the most Bytes that a ZIP entry of size Bytes can take."""
+    if compress_type != zipfile.ZIP_STORED:
+        size = int(size * WORST_CASE_RATIO) + 1024
+    return size + 2 * len(name.encode("utf-8")) + ZIP_ENTRY_OVERHEAD
+
+
+def estimate_zip_size(state, relatives):
+    """Return worst case ZIP size in bytes for relatives files of state."""
+    return sum(get_worst_case_size(state[relative][0], relative)
+               for relative in relatives) + 1024 * 1024
+
+
+class HashingWriter(object):
+
+    """Write only file wrapper that hashes and counts what goes through it.
+
+    It has no seek, so zipfile writes the ZIP in 1 pass with data
+    descriptors, and the checksum is ready when the ZIP is closed.
+    """
+
+    def __init__(self, output, algorithm="sha1", throttle=None):
+        """Init class."""
+        self.output, self.throttle, self.position = output, throttle, 0
+        self.checksum = hashlib.new(algorithm)
+
+    def write(self, data):
+        """Write data, hash it and account it on throttle."""
+        if self.throttle:
+            self.throttle.write(len(data))
+        self.checksum.update(data)
+        self.output.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        """Return how many Bytes were written."""
+        return self.position
+
+    def flush(self):
+        """Flush the wrapped file."""
+        self.output.flush()
+
+
+def read_block(path, offset, size, throttle=None):
+    """Return size Bytes of path from offset, less at the end of file."""
+    with open(path, "rb") as source:
+        source.seek(offset)
+        data = source.read(size)
+    if throttle:
+        throttle.read(len(data))
+    return data
+
+
+def deflate_block(data, level=None, final=False):
+    """Return data as raw deflate blocks ending on a sync flush, or final.
+
+    Each block is compressed on its own, so blocks are compressed on any
+    thread and joined in order as 1 valid deflate stream, like pigz does.
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+        zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def compress_block(read, compress_type, level=None, final=False):
+    """Return (data, compressed, final) of the block read by future read.
+
+    Other codecs can not be split, the writer compresses them in order.
+    """
+    data = read.result()  # compressors wait for readers, never the opposite
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return data, deflate_block(data, level, final), final
+    return data, data, final
+
+
+class ZipPipeline(object):
+
+    """Read and compress files ahead of the single thread writing a ZIP.
+
+    A dispatcher thread walks the files in order and reserves memory for
+    each block of CHECKSUM_CHUNK_SIZE, then reader threads read it and
+    compressor threads compress it, the writer frees it once written. So
+    disk reads, compression and writes overlap on PIPELINE_MEMORY_MB at most.
+    room is how many Bytes still fit on the volume, 0 is unlimited, the
+    writer lowers it as it goes, so what can not fit is never read.
+    """
+
+    def __init__(self, folder, relatives, start, options, state=None,
+                 throttle=None, segment_size=0, room=0):
+        """Init class, start reading right away."""
+        compression, self.level = get_compression(options)
+        self.compress_type = ZIP_CODECS[compression]
+        self.permits = threading.Semaphore(max(2, int(
+            options["PIPELINE_MEMORY_MB"]) * 1024 * 1024 // (
+                2 * CHECKSUM_CHUNK_SIZE)))  # data and compressed data
+        self.entries, self.in_flight, self.error = Queue(), {}, None
+        self.dropped = None  # blocks queue of the file the writer dropped
+        self.room = room
+        self.lock, self.stop = threading.Lock(), threading.Event()
+        self.readers = ThreadPoolExecutor(PIPELINE_READERS)
+        self.compressors = ThreadPoolExecutor(
+            int(options["PIPELINE_THREADS"]) or max(1, (
+                os.cpu_count() or 1) // int(options.get(
+                    "WORKER_PROCESSES", 1))))
+        self.dispatcher = threading.Thread(
+            target=self.dispatch, daemon=True, args=(
+                folder, relatives, start, options, state or {}, throttle,
+                segment_size))
+        self.dispatcher.start()
+
+    def dispatch(self, folder, relatives, start, options, state, throttle,
+                 segment_size):
+        """Put (index, relative, info, blocks) of every file on entries.
+
+        info is the exception if the file can not be read, blocks a queue of
+        futures of compress_block ending on None. Stops once segment_size
+        Bytes of files are planned, the writer may stop before that.
+        """
+        index, offset = start
+        planned = 0
+        try:
+            while index < len(relatives) and not self.stop.is_set():
+                if segment_size and planned >= segment_size:
+                    break
+                relative = relatives[index]
+                path = os.path.join(folder, *relative.split("/"))
+                try:
+                    info = zipfile.ZipInfo.from_file(
+                        path, relative, strict_timestamps=False)
+                except OSError as reason:  # file vanished or locked
+                    self.entries.put((index, relative, reason, None))
+                    index, offset = index + 1, 0
+                    continue
+                if relative in state:
+                    info.file_size = state[relative][0]
+                info.compress_type = self.compress_type
+                if options["STORE_COMPRESSED_FILES"] and (
+                        is_already_compressed(path, info.file_size)):
+                    info.compress_type = zipfile.ZIP_STORED
+                blocks = Queue()
+                # the writer changes info.file_size to the length it stores
+                size, compress_type = info.file_size, info.compress_type
+                self.entries.put((index, relative, info, blocks))
+                for block_offset in range(offset, size, CHECKSUM_CHUNK_SIZE):
+                    self.permits.acquire()
+                    if self.stop.is_set() or self.dropped is blocks or (
+                            self.room and block_offset - offset >= self.room):
+                        self.permits.release()
+                        break  # the rest of the file goes on the next volume
+                    read = self.readers.submit(
+                        read_block, path, block_offset, min(
+                            CHECKSUM_CHUNK_SIZE, size - block_offset),
+                        throttle)
+                    block = self.compressors.submit(
+                        compress_block, read, compress_type, self.level,
+                        block_offset + CHECKSUM_CHUNK_SIZE >= size)
+                    with self.lock:
+                        self.in_flight[block] = read
+                    blocks.put(block)
+                blocks.put(None)
+                planned += size - offset
+                index, offset = index + 1, 0
+        except Exception as reason:  # raised by the writer
+            self.error = reason
+        finally:
+            self.entries.put(None)
+
+    def release(self, block):
+        """Free the memory reserved for block, only once."""
+        with self.lock:
+            if self.in_flight.pop(block, None) is None:
+                return
+        self.permits.release()
+
+    def take(self, block):
+        """Return (data, compressed, final) of block, then free it."""
+        try:
+            return block.result()
+        finally:
+            self.release(block)
+
+    def discard(self, blocks):
+        """Free the blocks left on a blocks queue, not to be written.
+
+        The dispatcher stops reading that file, the reads not started yet
+        are cancelled, so a file split on many volumes is read only once.
+        """
+        self.dropped = blocks
+        for block in iter(blocks.get, None):
+            with self.lock:
+                read = self.in_flight.get(block)
+            if read is not None:
+                read.cancel()
+            block.cancel()
+            self.release(block)
+
+    def close(self):
+        """Stop reading ahead, free the blocks not written, wait threads."""
+        self.stop.set()
+        while self.dispatcher.is_alive() or self.in_flight:
+            with self.lock:
+                blocks = list(self.in_flight.items())
+            for block, read in blocks:
+                read.cancel()
+                block.cancel()
+                self.release(block)
+            self.dispatcher.join(0.01)
+        self.readers.shutdown()
+        self.compressors.shutdown()
+
+
+def write_zip_entry(zip_file, info, blocks, length, pipeline):
+    """Write info and its blocks, up to length Bytes, as a ZIP entry.
+
+    The local header goes first without CRC nor sizes, then the data, then
+    a data descriptor with them, so nothing is seeked nor read back. The
+    first block is read before writing anything, an unreadable file raises
+    OSError and leaves no entry. Blocks after length are freed, not written.
+    Returns why the entry is shorter than length (a later block could not be
+    read or the file shrank), None if it is complete.
+    """
+    block = blocks.get()
+    try:
+        data, compressed, final = pipeline.take(block) if block else (
+            b"", b"", False)
+    except OSError:
+        pipeline.discard(blocks)
+        raise
+    zip64 = length * 1.05 > zipfile.ZIP64_LIMIT  # as zipfile does
+    compressor = None if info.compress_type in (
+        zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) else (
+            zipfile._get_compressor(info.compress_type, pipeline.level))
+    info.file_size, info.flag_bits = length, info.flag_bits | DATA_DESCRIPTOR
+    info.header_offset = zip_file.fp.tell()
+    zip_file.fp.write(info.FileHeader(zip64))
+    crc = size_in = size_out = 0
+    reason = None
+    while True:
+        if size_in + len(data) > length:  # last piece of a split file
+            data, final = data[:length - size_in], True
+            compressed = deflate_block(data, pipeline.level, final) if (
+                info.compress_type == zipfile.ZIP_DEFLATED) else data
+        if compressor:
+            compressed = compressor.compress(data)
+        crc = zlib.crc32(data, crc)
+        zip_file.fp.write(compressed)
+        size_in, size_out = size_in + len(data), size_out + len(compressed)
+        if size_in >= length or not block:
+            break
+        block = blocks.get()
+        if not block:
+            break
+        try:
+            data, compressed, final = pipeline.take(block)
+        except OSError as error:  # keep what was read, skip the rest
+            reason = error
+            break
+    if block:  # rest of a split file, or of a file that failed
+        pipeline.discard(blocks)
+    if compressor:
+        compressed = compressor.flush()
+    elif info.compress_type == zipfile.ZIP_DEFLATED and not final:
+        compressed = zlib.compressobj(1, zlib.DEFLATED, -15).flush()  # end
+    else:
+        compressed = b""
+    zip_file.fp.write(compressed)
+    info.CRC, info.compress_size, info.file_size = (
+        crc, size_out + len(compressed), size_in)
+    zip_file.fp.write(struct.pack(
+        "<4sLQQ" if zip64 else "<4sLLL", b"PK\x07\x08", info.CRC,
+        info.compress_size, info.file_size))
+    zip_file.filelist.append(info)  # as zipfile does, for central directory
+    zip_file.NameToInfo[info.filename] = info
+    zip_file.start_dir = zip_file.fp.tell()
+    if reason is None and size_in < length:
+        reason = "read {} of {} Bytes, file shrank".format(size_in, length)
+    return reason
+
+
+def get_changed_reason(path, size, values=None):
+    """Return why path changed since scanned with size, None if it did not.
+
+    values are [size, mtime, hash] of the scanned state, if given.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as reason:
+        return reason
+    if stat.st_size != size:
+        return "changed while read, {} Bytes now, {} stored".format(
+            stat.st_size, size)
+    if values and int(stat.st_mtime) != values[1]:
+        return "modified while read"
+    return None
+
+
+def write_zip_volume(zip_filename, folder, relatives, manifest, start=(0, 0),
+                     max_size=0, segment_size=0, progress=None, options=None,
+                     report=None, state=None, throttle=None):
+    """Write relatives files of folder plus its manifest to a ZIP volume.
+
+    Starts at start (index on relatives, offset on that file) and stops
+    before the volume grows over max_size Bytes, splitting the file that
+    does not fit on pieces listed on the manifest, or once segment_size
+    Bytes of files are stored. Writes directly on destination as a *.part
+    temporary file, atomically renamed to zip_filename when complete, so
+    there is never a half ZIP. Calls progress(relative_path, size_in_bytes)
+    after each archived file or piece, sizes come from the scanned state if
+    given, instead of stat again. Files are read and compressed ahead on a
+    ZipPipeline and hashed as written, throttle limits read and write rate.
+    Files that can not be read, read short or changed while read are counted
+    as errors and listed on manifest["errors"] with the reason, their entry
+    is left out of the central directory and the rest of it is not stored.
+    manifest["last"] is True on the volume that stores the last file.
+    Returns (index, offset) of the next volume and the ZIP checksum.
+    """
+    report = report or RunReport()
+    options = options or CONFIG_DEFAULTS
+    state = state or {}
+    temporary_filename = zip_filename + ".part"
+    index, offset = start
+    manifest["pieces"], manifest["errors"] = {}, {}
+
+    def failed(relative, reason):
+        log.warning("{}: {}.".format(relative, reason))
+        report.count("errors")
+        manifest["errors"][relative] = str(reason)
+        return len(dumps([relative, str(reason)]).encode("utf-8"))
+
+    # room for the manifest, 2 pieces at most, end of central directory and
+    # the central directory entries of every written file, added below
+    reserved = len(dumps(manifest).encode("utf-8")) + 2 * 1024
+    pipeline = ZipPipeline(folder, relatives, start, options, state, throttle,
+                           segment_size, max(max_size - reserved, 1) if (
+                               max_size) else 0)
+    try:
+        with open(temporary_filename, "wb") as raw_file:
+            output = HashingWriter(raw_file, get_checksum_algorithm(options),
+                                   throttle)
+            with zipfile.ZipFile(output, "w", allowZip64=True,
+                                 strict_timestamps=False) as zip_file:
+                for index, relative, info, blocks in iter(
+                        pipeline.entries.get, None):
+                    if isinstance(info, Exception):
+                        reserved += failed(relative, info)
+                        index, offset = index + 1, 0
+                        continue
+                    start_time = time.perf_counter()
+                    size = info.file_size
+                    length = max(size - offset, 0)
+                    if max_size and get_worst_case_size(
+                            length, relative, info.compress_type) > (
+                                max_size - output.tell() - reserved):
+                        stored_only = info.compress_type == zipfile.ZIP_STORED
+                        length = max(int((
+                            max_size - output.tell() - reserved -
+                            get_worst_case_size(0, relative) -
+                            (0 if stored_only else 1024)) / (
+                                1 if stored_only else WORST_CASE_RATIO)),
+                            0)  # what still fits
+                        if length < MIN_PIECE_SIZE:
+                            if not output.tell():
+                                raise ValueError(
+                                    "MAX_VOLUME_SIZE_MB is too small.")
+                            break  # volume is full, next file on next one
+                    if offset or length < size:
+                        manifest["pieces"][relative] = [offset, length, size]
+                    try:
+                        reason = write_zip_entry(zip_file, info, blocks,
+                                                 length, pipeline)
+                    except OSError as reason:  # file vanished or locked
+                        reserved += failed(relative, reason)
+                        manifest["pieces"].pop(relative, None)
+                        index, offset = index + 1, 0
+                        continue
+                    if reason is None and offset + length >= size:
+                        reason = get_changed_reason(os.path.join(
+                            folder, *relative.split("/")), size,
+                            state.get(relative))
+                    if reason is not None:  # left out, the rest too
+                        reserved += failed(relative, reason)
+                        zip_file.filelist.remove(info)
+                        del zip_file.NameToInfo[relative]
+                        manifest["pieces"].pop(relative, None)
+                        index, offset = index + 1, 0
+                        continue
+                    report.record_file(
+                        relative, time.perf_counter() - start_time,
+                        info.file_size, info.compress_size)
+                    if progress:
+                        progress(relative, info.file_size)
+                    reserved += ZIP_ENTRY_OVERHEAD + len(
+                        relative.encode("utf-8"))
+                    if max_size:
+                        pipeline.room = max(max_size - output.tell() -
+                                            reserved, 1)
+                    offset += length
+                    if offset < size:
+                        break  # volume is full, rest of the file on next one
+                    index, offset = index + 1, 0
+                if pipeline.error:
+                    raise pipeline.error
+                manifest["last"] = index >= len(relatives)
+                zip_file.writestr(MANIFEST_FILENAME,
+                                  dumps(manifest, sort_keys=True))
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(temporary_filename, zip_filename)
+        fsync_folder(os.path.dirname(os.path.abspath(zip_filename)))
+    except BaseException:
+        if os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    finally:
+        pipeline.close()
+    return index, offset, output.checksum.hexdigest()
+
+
+def write_backup_zip(zip_filename, folder, relatives, manifest,
+                     progress=None, options=None, report=None, state=None,
+                     throttle=None):
+    """Write all the relatives files of folder plus its manifest to a ZIP."""
+    write_zip_volume(zip_filename, folder, relatives, manifest,
+                     progress=progress, options=options, report=report,
+                     state=state, throttle=throttle)
+    return zip_filename
+
+
+@contextmanager
+def reserved_space(folder, size, reservations=None):
+    """Reserve size Bytes of folder while writing, OSError if not free.
+
+    reservations is a (Value, Lock) pair of a Manager shared by the worker
+    processes, so 2 volumes never count on the same free Bytes.
+    """
+    if reservations is None:
+        if get_free_space_on_disk(folder) < size:
+            raise OSError("No Free Space on {}, {} Bytes needed.".format(
+                folder, size))
+        yield
+        return
+    reserved, lock = reservations
+    with lock:
+        free_space = get_free_space_on_disk(folder) - reserved.value
+        log.info("Reserving {} Bytes, Free Space: {} Bytes.".format(
+            size, free_space))
+        if free_space < size:
+            raise OSError("No Free Space on {}, {} Bytes needed.".format(
+                folder, size))
+        reserved.value += size
+    try:
+        yield
+    finally:
+        with lock:
+            reserved.value -= size
+
+
+def copy_volume(zip_filename, folders, snapshot):
+    """Copy a finished volume to the first of folders with enough space."""
+    size = os.path.getsize(zip_filename)
+    for folder in folders:
+        target = os.path.join(folder, snapshot, os.path.basename(zip_filename))
+        if os.path.isfile(target) and os.path.getsize(target) == size:
+            return target  # copied before resuming
+        if get_free_space_on_disk(folder) < size:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(zip_filename, target + ".part")
+        fsync_file(target + ".part")
+        os.replace(target + ".part", target)
+        fsync_folder(os.path.dirname(target))
+        log.info("Copied volume {} to {}.".format(zip_filename, target))
+        return target
+    raise OSError("No Free Space to copy {} on {}.".format(
+        zip_filename, folders))
+
+
+def get_segment_filename(zip_filename, number):
+    """Return the ZIP filename of segment number, the first is zip_filename."""
+    if number == 1:
+        return zip_filename
+    return "{}.{:03d}.zip".format(zip_filename[:-len(".zip")], number)
+
+
+def archive_folder(folder_to_backup, zip_filename, entry, options,
+                   events=None, reservations=None):
+    """Archive folder, only new or modified files if index entry is given.
+
+    Runs on a worker process, so it only gets picklable arguments and never
+    touches the global config nor the GUI. Progress goes to the events queue
+    as ("total", folder, bytes) once, then ("file", folder, bytes) per file.
+    Files go to ZIP volumes of ~SEGMENT_SIZE_MB of files and MAX_VOLUME_SIZE_MB
+    at most, each logged on a journal next to zip_filename so an interrupted
+    run resumes after the last one. Free space is reserved on reservations
+    before writing a volume, then ("volume", folder, zip_filename) is sent.
+    Returns the ZIP filenames and their checksums, the new folder state, if
+    it is a full backup and a RunReport, no ZIP filenames if nothing changed.
+    Files that failed are left out of the state, the next run stores them.
+    """
+    report = RunReport()
+    journal_filename = zip_filename + SEGMENT_JOURNAL
+    journal = read_json_lines(journal_filename)
+    if journal:
+        plan, segments = journal[0], journal[1:]
+        state, changed, deleted, full, base = (
+            plan["state"], plan["changed"], plan["deleted"], plan["full"],
+            plan["base"])
+        log.info("Resuming Backup of {} after {} segments.".format(
+            folder_to_backup, len(segments)))
+    else:
+        segments = []
+        full = not entry or entry["incrementals"] + 1 >= int(
+            options["MAKE_FULL_BACKUP_EVERY"])
+        previous = {} if full else entry["files"]
+        with report.stage("scan"):
+            state = scan_folder_state(
+                folder_to_backup, entry and entry["files"],
+                options["INCREMENTAL_HASH_CONTENT"],
+                get_path_rules(options, folder_to_backup),
+                options["SCAN_THREADS"])
+            changed, deleted = diff_folder_state(previous, state)
+        base = None if full else entry["snapshot"]
+    report.count("files_scanned", len(state))
+    report.count("files_deleted", len(deleted))
+    log.info("{} Backup of {}: {} changed, {} deleted files.".format(
+        "Full" if full else "Incremental", folder_to_backup, len(changed),
+        len(deleted)))
+    done, offset = (segments[-1]["done"], segments[-1].get("offset", 0)) if (
+        segments) else (0, 0)
+    if events is not None:
+        events.put(("total", folder_to_backup,
+                    sum(state[relative][0] for relative in changed)))
+        events.put(("file", folder_to_backup, offset + sum(
+            state[relative][0] for relative in changed[:done])))
+    if not (full or changed or deleted):
+        log.info("Nothing changed on {}, skipping.".format(folder_to_backup))
+        report.stop()
+        return [], [], state, full, report
+    if not journal:
+        append_json_line(journal_filename, {
+            "state": state, "changed": changed, "deleted": deleted,
+            "full": full, "base": base})
+    progress = None if events is None else (
+        lambda relative, size: events.put(("file", folder_to_backup, size)))
+    throttle = Throttle(options, options.get("WORKER_PROCESSES", 1), report)
+    segment_size = int(options["SEGMENT_SIZE_MB"]) * 1024 * 1024
+    max_size = int(options["MAX_VOLUME_SIZE_MB"]) * 1024 * 1024
+    zip_filenames = [os.path.join(os.path.dirname(zip_filename),
+                                  segment["zip"]) for segment in segments]
+    checksums = [segment.get("checksum") for segment in segments]
+    for segment_filename in zip_filenames:  # copied before resuming?
+        if events is not None:
+            events.put(("volume", folder_to_backup, segment_filename))
+    while done < len(changed) or not zip_filenames:
+        segment_filename = get_segment_filename(zip_filename,
+                                                len(zip_filenames) + 1)
+        manifest = {"origin": folder_to_backup,
+                    "deleted": [] if zip_filenames else deleted,
+                    "type": "full" if full else "incremental",
+                    "base": base, "segment": len(zip_filenames) + 1}
+        volume_size = estimate_zip_size(state, changed[done:]) - offset
+        if max_size:
+            volume_size = min(volume_size, max_size)
+        with ExitStack() as reservation:
+            with report.stage("free_space"):
+                reservation.enter_context(reserved_space(
+                    os.path.dirname(zip_filename), volume_size, reservations))
+            with report.stage("compress"):
+                done, offset, checksum = write_zip_volume(
+                    segment_filename, folder_to_backup, changed, manifest,
+                    (done, offset), max_size, segment_size, progress,
+                    options, report, state, throttle)
+        zip_filenames.append(segment_filename)
+        checksums.append(checksum)
+        segments.append({
+            "zip": os.path.basename(segment_filename), "done": done,
+            "offset": offset, "checksum": checksum,
+            "errors": sorted(manifest["errors"])})
+        append_json_line(journal_filename, segments[-1])
+        if events is not None:
+            events.put(("volume", folder_to_backup, segment_filename))
+    for segment in segments:  # not on the index, so the next run retries
+        for relative in segment.get("errors", ()):
+            state.pop(relative, None)
+    report.stop()
+    return zip_filenames, checksums, state, full, report
+
+
+def find_chunk_cut(data):
+    """Return where to cut the first content-defined chunk of data.
+
+    Gear rolling hash, only computed after CHUNK_MIN_SIZE (minus a window)
+    so half of the bytes are never hashed, cuts are forced at CHUNK_MAX_SIZE.
+    """
+    if len(data) <= CHUNK_MIN_SIZE:
+        return len(data)
+    gear, mask, rolling_hash = GEAR, CHUNK_MASK, 0
+    position = CHUNK_MIN_SIZE - 32  # warm up the hash with a 32 bytes window
+    for byte in data[position:CHUNK_MAX_SIZE]:
+        rolling_hash = ((rolling_hash << 1) + gear[byte]) & 0xFFFFFFFF
+        position += 1
+        if not rolling_hash & mask and position > CHUNK_MIN_SIZE:
+            return position
+    return min(len(data), CHUNK_MAX_SIZE)
+
+
+def iter_file_chunks(filename, throttle=None, fixed=False):
+    """Yield content-defined chunks of filename, using constant memory.
+
+    If fixed yield FIXED_CHUNK_SIZE chunks, the rolling hash is pure Python
+    and too slow for huge files, that rarely get bytes inserted anyway.
+    """
+    buffer = bytearray()
+    with open(filename, "rb") as file_to_chunk:
+        while fixed:
+            data = file_to_chunk.read(FIXED_CHUNK_SIZE)
+            if throttle:
+                throttle.read(len(data))
+            if not data:
+                return
+            yield data
+        while True:
+            data = file_to_chunk.read(CHUNK_MAX_SIZE)
+            if throttle:
+                throttle.read(len(data))
+            buffer += data
+            while len(buffer) >= CHUNK_MAX_SIZE or (buffer and not data):
+                cut = find_chunk_cut(memoryview(buffer))
+                yield bytes(buffer[:cut])
+                del buffer[:cut]
+            if not data:
+                return
+
+
+class DedupRepository(object):
+
+    """Deduplicated backup store, every chunk of data is stored only once.
+
+    Chunks live in append-only pack files, index.json maps chunk ID to
+    [pack, offset, length, codec] and every snapshot is a small manifest
+    with the chunk IDs of each file. Worker processes open their own
+    instance, write new chunks to their own pack and return the new index
+    entries, only the main process saves the index and the manifests.
+    """
+
+    def __init__(self, folder, options=None):
+        """Init class."""
+        self.folder, self.options = folder, options or CONFIG_DEFAULTS
+        self.compression, self.level = get_compression(self.options)
+        self.packs_folder = os.path.join(folder, "packs")
+        self.snapshots_folder = os.path.join(folder, "snapshots")
+        self.index_file = os.path.join(folder, "index.json")
+        for _folder in (self.packs_folder, self.snapshots_folder):
+            if not os.path.isdir(_folder):
+                os.makedirs(_folder)
+        self.index, self.new_chunks = {}, {}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, "r", encoding="utf-8") as _index:
+                self.index = loads(_index.read())
+        self.pack_file, self.pack_name, self.bytes_written = None, None, 0
+
+    def write_chunk(self, chunk, compression=None):
+        """Store chunk if not already stored, return the chunk ID."""
+        digest = hashlib.sha256(chunk).digest()
+        chunk_id = digest.hex()
+        if chunk_id in self.index or chunk_id in self.new_chunks:
+            return chunk_id
+        data, codec = compress_chunk(chunk, compression or self.compression,
+                                     self.level)
+        if self.pack_file is None or self.pack_file.tell() > PACK_MAX_SIZE:
+            self.close()
+            self.pack_name = uuid.uuid4().hex + ".pack"
+            self.pack_file = open(
+                os.path.join(self.packs_folder, self.pack_name), "ab")
+        self.pack_file.write(CHUNK_HEADER.pack(digest, codec, len(data)))
+        self.new_chunks[chunk_id] = [self.pack_name, self.pack_file.tell(),
+                                     len(data), codec]
+        self.pack_file.write(data)
+        self.bytes_written += CHUNK_HEADER.size + len(data)
+        return chunk_id
+
+    def write_file(self, filename, progress=None, throttle=None):
+        """Store filename as content-defined chunks, return the chunk IDs.
+
+        Bytes written to the packs are counted on self.bytes_written.
+        """
+        chunk_ids, compression, size = [], None, os.path.getsize(filename)
+        if self.options["STORE_COMPRESSED_FILES"] and is_already_compressed(
+                filename, size):
+            compression = "store"
+        fixed_over = int(self.options.get("DEDUP_FIXED_CHUNKS_OVER_MB", 0))
+        fixed = compression == "store" or (
+            fixed_over > 0 and size > fixed_over * 1024 * 1024)
+        for chunk in iter_file_chunks(filename, throttle, fixed):
+            bytes_written = self.bytes_written
+            chunk_ids.append(self.write_chunk(chunk, compression))
+            if throttle:
+                throttle.write(self.bytes_written - bytes_written)
+            if progress:
+                progress(len(chunk))
+        return chunk_ids
+
+    def read_chunk(self, chunk_id):
+        """Return the data of chunk_id, verifying its SHA256."""
+        pack_name, offset, length, codec = self.index[chunk_id]
+        with open(os.path.join(self.packs_folder, pack_name), "rb") as pack:
+            pack.seek(offset)
+            data = pack.read(length)
+        chunk = decompress_chunk(data, codec)
+        if hashlib.sha256(chunk).hexdigest() != chunk_id:
+            raise ValueError("Chunk {} is corrupt.".format(chunk_id))
+        return chunk
+
+    def close(self):
+        """Close the pack file being written, if any."""
+        if self.pack_file is not None:
+            self.pack_file.flush()
+            os.fsync(self.pack_file.fileno())
+            self.pack_file.close()
+            self.pack_file = None
+
+    def save(self, new_chunks=None):
+        """Merge new chunks into the index and save it atomically."""
+        self.index.update(new_chunks or self.new_chunks)
+        self.new_chunks = {}
+        save_json(self.index_file, self.index)
+
+    def list_snapshots(self):
+        """Return sorted list of snapshot names on the repository."""
+        return sorted(name[:-5] for name in os.listdir(self.snapshots_folder)
+                      if name.endswith(".json"))
+
+    def load_snapshot(self, name):
+        """Return the manifest of snapshot name."""
+        with open(os.path.join(self.snapshots_folder, name + ".json"),
+                  "r", encoding="utf-8") as _snapshot:
+            return loads(_snapshot.read())
+
+    def save_snapshot(self, name, origins):
+        """Save a snapshot manifest, origins is {origin: {relative: file}}."""
+        save_json(os.path.join(self.snapshots_folder, name + ".json"),
+                  {"snapshot": name, "origins": origins})
+        log.info("Saved Dedup Snapshot {}.".format(name))
+
+    def restore(self, origin, target, snapshot=None, paths=None):
+        """Rebuild origin as it was on snapshot (default latest) on target.
+
+        If paths is given only those relative paths of origin are restored.
+        """
+        snapshots = self.list_snapshots()
+        snapshot = snapshot or (snapshots[-1] if snapshots else None)
+        if snapshot not in snapshots:
+            raise FileNotFoundError("No snapshot {} on {}.".format(
+                snapshot, self.folder))
+        files = self.load_snapshot(snapshot)["origins"].get(origin)
+        if files is None:
+            raise FileNotFoundError("No backup of {} on {}.".format(
+                origin, snapshot))
+        for relative in set(paths or ()) - set(files):
+            raise FileNotFoundError("No backup of {} on {}.".format(
+                relative, origin))
+        if paths:
+            files = {relative: files[relative] for relative in paths}
+        for relative, (size, mtime, chunk_ids) in files.items():
+            path = os.path.join(target, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as restored_file:
+                for chunk_id in chunk_ids:
+                    restored_file.write(self.read_chunk(chunk_id))
+            os.utime(path, (mtime, mtime))
+        log.info("Restored {} from {} into {}.".format(
+            origin, snapshot, target))
+        return snapshot
+
+    def prune(self, keep_last):
+        """Remove all snapshot manifests except the keep_last newest ones."""
+        snapshots = self.list_snapshots()
+        expired = snapshots[:-keep_last] if keep_last > 0 else []
+        self.forget(expired)
+        return expired
+
+    def forget(self, names):
+        """Remove the manifests of snapshot names, gc reclaims their chunks."""
+        for name in names:
+            log.info("Pruning Dedup Snapshot {}.".format(name))
+            os.remove(os.path.join(self.snapshots_folder, name + ".json"))
+
+    def get_chunks(self):
+        """Return the chunk IDs and the origins of every snapshot.
+
+        As {snapshot: set of chunk IDs it references} and {snapshot: origins
+        it holds}, from the snapshot manifests.
+        """
+        chunks, origins = {}, {}
+        for name in self.list_snapshots():
+            manifest = self.load_snapshot(name)
+            origins[name] = set(manifest["origins"])
+            chunks[name] = {chunk_id for files in manifest[
+                "origins"].values() for size, mtime, chunk_ids in (
+                    files.values()) for chunk_id in chunk_ids}
+        return chunks, origins
+
+    def gc(self, repack_ratio=0.75):
+        """Reclaim chunks not referenced by any snapshot.
+
+        Packs without live chunks are deleted, packs with less than
+        repack_ratio of live bytes are rewritten, returns bytes reclaimed.
+        """
+        referenced = set()
+        for name in self.list_snapshots():
+            for files in self.load_snapshot(name)["origins"].values():
+                for size, mtime, chunk_ids in files.values():
+                    referenced.update(chunk_ids)
+        live_bytes, packs = {}, {}
+        for chunk_id, (pack_name, offset, length, codec) in list(
+                self.index.items()):
+            if chunk_id not in referenced:
+                del self.index[chunk_id]
+                continue
+            packs.setdefault(pack_name, []).append(chunk_id)
+            live_bytes[pack_name] = live_bytes.get(pack_name, 0) + (
+                CHUNK_HEADER.size + length)
+        obsolete, reclaimed = [], 0
+        for pack_name in sorted(os.listdir(self.packs_folder)):
+            pack_size = os.path.getsize(
+                os.path.join(self.packs_folder, pack_name))
+            if live_bytes.get(pack_name, 0) >= pack_size * repack_ratio:
+                continue
+            for chunk_id in packs.get(pack_name, ()):  # repack live chunks
+                chunk, codec = self.read_chunk(chunk_id), self.index[
+                    chunk_id][3]
+                del self.index[chunk_id]
+                self.write_chunk(chunk, CHUNK_CODECS[codec])
+            obsolete.append(pack_name)
+            reclaimed += pack_size - live_bytes.get(pack_name, 0)
+        self.close()
+        self.save()  # index points to the new packs before deleting old ones
+        for pack_name in obsolete:
+            log.info("Deleting Dedup Pack {}.".format(pack_name))
+            os.remove(os.path.join(self.packs_folder, pack_name))
+        log.info("Dedup GC reclaimed {} Bytes.".format(reclaimed))
+        return reclaimed
+
+
+def dedup_archive_folder(repository_folder, folder_to_backup, previous,
+                         options, events=None):
+    """Store folder on the deduplicated repository, on a worker process.
+
+    Files with the same size and mtime as on previous snapshot reuse their
+    chunk IDs without reading them. Returns the files manifest of the folder,
+    the new chunks that the main process must merge into the index and a
+    RunReport with timings.
+    """
+    repository, report = DedupRepository(repository_folder, options), (
+        RunReport())
+    throttle = Throttle(options, options.get("WORKER_PROCESSES", 1), report)
+    with report.stage("scan"):
+        state = scan_folder_state(
+            folder_to_backup, rules=get_path_rules(options, folder_to_backup),
+            threads=options["SCAN_THREADS"])
+        changed, deleted = diff_folder_state(
+            {relative: values[:2] + [None] for relative, values in
+             previous.items()}, state)
+    report.count("files_scanned", len(state))
+    report.count("files_deleted", len(deleted))
+    if events is not None:
+        events.put(("total", folder_to_backup,
+                    sum(state[relative][0] for relative in changed)))
+    progress = None if events is None else (
+        lambda size: events.put(("file", folder_to_backup, size)))
+    files = {}
+    try:
+        for relative, (size, mtime, _) in state.items():
+            if relative not in changed:
+                files[relative] = previous[relative]
+                continue
+            path = os.path.join(folder_to_backup, *relative.split("/"))
+            start, bytes_written = time.perf_counter(), (
+                repository.bytes_written)
+            try:
+                with report.stage("compress"):
+                    files[relative] = [size, mtime, repository.write_file(
+                        path, progress, throttle)]
+            except OSError as reason:  # file vanished or locked meanwhile
+                log.warning(reason)
+                report.count("errors")
+                continue
+            report.record_file(relative, time.perf_counter() - start, size,
+                               repository.bytes_written - bytes_written)
+    finally:
+        repository.close()
+    log.info("Dedup Backup of {}: {} changed files, {} new chunks.".format(
+        folder_to_backup, len(changed), len(repository.new_chunks)))
+    report.stop()
+    return files, repository.new_chunks, report
+
+
+def lower_process_priority(priority="low"):
+    """Lower CPU and IO priority of the current (worker) process.
+
+    low is below normal CPU and lowest best-effort IO, idle only runs when
+    nothing else wants the CPU or the disk.
+    """
+    if priority not in ("low", "idle"):
+        return
+    try:
+        if sys.platform.startswith("win"):  # Background mode lowers IO too
+            if priority == "idle":
+                ctypes.windll.kernel32.SetPriorityClass(
+                    ctypes.windll.kernel32.GetCurrentProcess(), 0x00000040)
+            ctypes.windll.kernel32.SetPriorityClass(
+                ctypes.windll.kernel32.GetCurrentProcess(), 0x00100000)
+            return
+        os.nice(19 if priority == "idle" else 10)
+        if sys.platform.startswith("linux") and (
+                platform.machine().lower() in IOPRIO_SET):
+            # IOPRIO_WHO_PROCESS, class idle or best-effort level 7
+            ioprio = 3 << 13 if priority == "idle" else 2 << 13 | 7
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(IOPRIO_SET[platform.machine().lower()], 1, 0,
+                            ioprio) != 0:
+                log.warning(os.strerror(ctypes.get_errno()))
+    except Exception as reason:
+        log.warning(reason)
+
+
+class FILETIME(ctypes.Structure):
+
+    """CTypes Structure of a MS Windows FILETIME, 100 nanoseconds ticks."""
+
+    _fields_ = [("dwLowDateTime", wintypes.DWORD),
+                ("dwHighDateTime", wintypes.DWORD)]
+
+    def ticks(self):
+        """Return the time as an integer of 100 nanoseconds ticks."""
+        return self.dwHighDateTime << 32 | self.dwLowDateTime
+
+
+class PDH_FMT_COUNTERVALUE(ctypes.Structure):
+
+    """CTypes Structure of a MS Windows performance counter as double."""
+
+    _fields_ = [("CStatus", wintypes.DWORD), ("doubleValue", ctypes.c_double)]
+
+
+class SystemLoad(object):
+
+    """Sample CPU load and disk queue depth of the whole system.
+
+    Values are of every program, backup included, so callers subtract the
+    load of its own workers. Returns None when it can not be measured.
+    """
+
+    def __init__(self):
+        """Init class."""
+        self.cpu_times, self.query, self.counter = None, None, None
+        self.own_times = None
+
+    def get_cpu_load(self):
+        """Return CPU load per CPU, 1.0 means all CPUs are busy."""
+        if hasattr(os, "getloadavg"):
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        if not sys.platform.startswith("win"):
+            return None
+        idle, kernel, user = FILETIME(), FILETIME(), FILETIME()
+        if not ctypes.windll.kernel32.GetSystemTimes(
+                ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+            return None
+        previous, self.cpu_times = self.cpu_times, (
+            idle.ticks(), kernel.ticks() + user.ticks())  # kernel has idle
+        if previous is None:
+            return None
+        total = self.cpu_times[1] - previous[1]
+        return 1 - (self.cpu_times[0] - previous[0]) / total if total else 0
+
+    def get_own_load(self):
+        """Return how many CPUs this process used since the last call.
+
+        Counts every thread, so the ZipPipeline readers and compressors too.
+        """
+        times = os.times()
+        previous, self.own_times = self.own_times, (
+            times.user + times.system, time.monotonic())
+        if previous is None or self.own_times[1] <= previous[1]:
+            return None
+        return (self.own_times[0] - previous[0]) / (
+            self.own_times[1] - previous[1])
+
+    def get_disk_queue_depth(self):
+        """Return how many IO requests are waiting on the physical disks."""
+        if sys.platform.startswith("linux"):
+            try:
+                disks = set(os.listdir("/sys/block"))
+                with open("/proc/diskstats", "r") as diskstats:
+                    return sum(int(line.split()[11]) for line in diskstats
+                               if line.split()[2] in disks and not
+                               line.split()[2].startswith(("loop", "ram")))
+            except (OSError, IndexError, ValueError):
+                return None
+        if not sys.platform.startswith("win"):
+            return None
+        pdh = ctypes.windll.pdh
+        if self.query is None:
+            self.query, self.counter = wintypes.HANDLE(), wintypes.HANDLE()
+            if pdh.PdhOpenQueryW(None, None, ctypes.byref(self.query)) or (
+                    pdh.PdhAddEnglishCounterW(
+                        self.query,
+                        "\\PhysicalDisk(_Total)\\Current Disk Queue Length",
+                        None, ctypes.byref(self.counter))):
+                return None
+        value = PDH_FMT_COUNTERVALUE()
+        if pdh.PdhCollectQueryData(self.query) or (
+                pdh.PdhGetFormattedCounterValue(
+                    self.counter, 0x00000200, None, ctypes.byref(value))):
+            return None  # 0x200 is PDH_FMT_DOUBLE
+        return value.doubleValue
+
+    def get_busy_reason(self, options, workers=1):
+        """Return why the backup should pause now, None if it can go on."""
+        if not options.get("MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY", True) and (
+                windows_is_running_on_battery()):
+            return "running on battery"
+        max_load = float(options["BACKOFF_MAX_LOAD"])
+        load = self.get_cpu_load() if max_load else None
+        if load is not None:  # workers use about as much CPU as this one
+            own = self.get_own_load()
+            load -= workers * (1 if own is None else own) / (
+                os.cpu_count() or 1)
+            if load > max_load:
+                return "CPU load {:.2f} per CPU".format(load)
+        max_queue = float(options["BACKOFF_MAX_DISK_QUEUE"])
+        queue = self.get_disk_queue_depth() if max_queue else None
+        if queue is not None:  # requests in flight of the backup itself
+            queue -= workers * (PIPELINE_READERS + 1 if options.get(
+                "REPOSITORY_MODE") == "zip" else 1)
+            if queue > max_queue:
+                return "disk queue depth {:.0f}".format(queue)
+        return None
+
+
+class Throttle(object):
+
+    """Token bucket rate limiter of read and write Bytes, with backoff.
+
+    Worker processes get 1 bucket each, with their share of the rates.
+    Every BACKOFF_CHECK_SECONDS it looks at the system, pausing while it is
+    busy for up to BACKOFF_MAX_PAUSE_SECONDS, then it goes on anyway.
+    """
+
+    def __init__(self, options, workers=1, report=None):
+        """Init class."""
+        self.options, self.workers = options, max(1, int(workers))
+        self.report, self.load = report or RunReport(), SystemLoad()
+        self.rates = {
+            "read": float(options["READ_LIMIT_MB_S"]) * 1024 * 1024 /
+            self.workers,
+            "write": float(options["WRITE_LIMIT_MB_S"]) * 1024 * 1024 /
+            self.workers}
+        self.tokens = {"read": 0.0, "write": 0.0}
+        self.updated = {"read": time.monotonic(), "write": time.monotonic()}
+        self.locks = {"read": threading.Lock(), "write": threading.Lock()}
+        self.next_check, self.lock = 0, threading.Lock()
+
+    def consume(self, kind, size):
+        """Take size Bytes of kind from the bucket, sleep if it is empty.
+
+        Thread safe, each thread takes its Bytes under the lock of kind and
+        sleeps off its own debt outside it, so threads share the same rate
+        and readers never wait for a sleeping writer.
+        """
+        with self.lock:  # a pause stops every thread
+            self.backoff()
+        rate = self.rates[kind]
+        if not rate:
+            return
+        with self.locks[kind]:
+            now = time.monotonic()  # refill, bursts of at most 1 second
+            self.tokens[kind] = min(rate, self.tokens[kind] + (
+                now - self.updated[kind]) * rate) - size
+            self.updated[kind] = now
+            seconds = max(0, -self.tokens[kind] / rate)
+            if seconds:
+                self.report.count("throttle_seconds", seconds)
+        time.sleep(seconds)
+
+    def read(self, size):
+        """Account size Bytes read."""
+        self.consume("read", size)
+
+    def write(self, size):
+        """Account size Bytes written."""
+        self.consume("write", size)
+
+    def backoff(self):
+        """Pause while the system is busy, up to BACKOFF_MAX_PAUSE_SECONDS."""
+        start = time.monotonic()
+        if start < self.next_check:
+            return
+        self.next_check = start + BACKOFF_CHECK_SECONDS
+        deadline = start + float(self.options["BACKOFF_MAX_PAUSE_SECONDS"])
+        reason = self.load.get_busy_reason(self.options, self.workers)
+        if reason is None:
+            return
+        log.info("Pausing Backup, {}.".format(reason))
+        while reason is not None and time.monotonic() < deadline:
+            time.sleep(BACKOFF_CHECK_SECONDS)
+            reason = self.load.get_busy_reason(self.options, self.workers)
+        log.info("Resuming Backup{}.".format(
+            "" if reason is None else ", paused too long"))
+        self.report.count("backoff_pauses")
+        self.report.count("backoff_seconds", time.monotonic() - start)
+        self.next_check = time.monotonic() + BACKOFF_CHECK_SECONDS
+        for kind in self.locks:  # no burst for the time paused
+            with self.locks[kind]:
+                self.updated[kind] = time.monotonic()
+
+
+def get_worker_options(max_workers=1):
+    """Return the picklable subset of config that worker processes need."""
+    options = {key: config[key] for key in CONFIG_DEFAULTS}
+    options["MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY"] = config.get(
+        "MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY", True)
+    options["WORKER_PROCESSES"] = max_workers  # they share the rate limits
+    return options
+
+
+def get_max_workers(origins_count):
+    """Return how many worker processes to use for origins_count folders."""
+    max_workers = int(config["MAX_WORKERS"]) or os.cpu_count() or 1
+    return max(1, min(max_workers, origins_count))
+
+
+def list_snapshots(folder):
+    """Return sorted list of timestamped snapshot folder names on folder."""
+    snapshots = []
+    for name in os.listdir(folder) if os.path.isdir(folder) else ():
+        try:
+            datetime.strptime(name, SNAPSHOT_FORMAT)
+        except ValueError:
+            continue
+        if os.path.isdir(os.path.join(folder, name)):
+            snapshots.append(name)
+    return sorted(snapshots)
+
+
+def read_manifest(zip_filename):
+    """Return the Vacap manifest stored inside a backup ZIP, or None."""
+    try:
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            return loads(zip_file.read(MANIFEST_FILENAME).decode("utf-8"))
+    except (KeyError, zipfile.BadZipFile, OSError, ValueError):
+        return None
+
+
+def restore_backup(folder, origin, target, snapshot=None):
+    """Rebuild origin as it was on snapshot into target folder.
+
+    Finds the last full backup at or before snapshot, then applies every
+    incremental after it in order, extracting files and removing tombstones.
+    Only complete snapshots count, segments 1 to the one marked as last.
+    """
+    chain = []
+    for name in list_snapshots(folder):
+        if snapshot and name > snapshot:
+            break
+        segments = []
+        for filename in os.listdir(os.path.join(folder, name)):
+            if not filename.endswith(".zip"):
+                continue
+            zip_filename = os.path.join(folder, name, filename)
+            manifest = read_manifest(zip_filename)
+            if manifest and manifest["origin"] == origin:
+                segments.append((manifest.get("segment", 1), zip_filename,
+                                 manifest))
+        numbers = [number for number, _, _ in sorted(segments)]
+        if not segments:
+            continue
+        if numbers != list(range(1, len(numbers) + 1)) or not any(
+                manifest.get("last", True) for _, _, manifest in segments):
+            log.warning("Skipping incomplete {} of {}.".format(name, origin))
+            continue  # killed or failed run, the volumes are not all there
+        for number, zip_filename, manifest in sorted(segments):
+            if manifest["type"] == "full" and number == 1:
+                chain = []
+            chain.append((zip_filename, manifest))
+    if not chain or chain[0][1]["type"] != "full":
+        raise FileNotFoundError("No full backup of {} on {}.".format(
+            origin, folder))
+    failed = set()  # (snapshot folder, path) not stored, keep older copy
+    for zip_filename, manifest in chain:
+        for relative in manifest.get("errors", {}):
+            failed.add((os.path.dirname(zip_filename), relative))
+    for zip_filename, manifest in chain:
+        log.info("Restoring {} into {}.".format(zip_filename, target))
+        pieces, snapshot_folder = manifest.get("pieces", {}), (
+            os.path.dirname(zip_filename))
+        with zipfile.ZipFile(zip_filename) as zip_file:
+            zip_file.extractall(target, [
+                name for name in zip_file.namelist()
+                if name != MANIFEST_FILENAME and name not in pieces and
+                (snapshot_folder, name) not in failed])
+            for relative, (offset, length, size) in pieces.items():
+                if (snapshot_folder, relative) in failed:
+                    continue
+                path = os.path.join(target, *relative.split("/"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with zip_file.open(relative) as piece, open(
+                        path, "r+b" if offset else "wb") as restored_file:
+                    restored_file.seek(offset)  # pieces come in order
+                    shutil.copyfileobj(piece, restored_file)
+        for relative in manifest["deleted"]:
+            path = os.path.join(target, *relative.split("/"))
+            if os.path.isfile(path):
+                os.remove(path)
+    return chain[-1][0]
+
+
+class Catalog(object):
+
+    """SQLite catalog of every file stored on the ZIP snapshots of a folder.
+
+    1 row per file (or piece of a file) with size, mtime, CRC, hash and the
+    offset of its local header, so files are found, listed, verified and
+    restored without opening whole ZIPs. Snapshots made before the catalog
+    existed are added the first time they are needed.
+    """
+
+    def __init__(self, folder):
+        """Init class."""
+        self.folder = folder
+        self.connection = sqlite3.connect(os.path.join(folder,
+                                                       CATALOG_FILENAME))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(CATALOG_SCHEMA)
+        # fnmatch ignores case on Windows, like its file system, GLOB never
+        self.connection.create_function("fnmatch", 2, fnmatch.fnmatch)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < (
+                CATALOG_VERSION):
+            with self.connection:
+                self.connection.execute("DELETE FROM snapshots")
+            self.connection.execute("PRAGMA user_version = {}".format(
+                CATALOG_VERSION))
+
+    def close(self):
+        """Close the SQLite connection."""
+        self.connection.close()
+
+    def add_volumes(self, snapshot, origin, zip_filenames, state=None):
+        """Add the files of zip_filenames, ZIP volumes of origin on snapshot.
+
+        Only reads the central directories, mtime and hash come from the
+        scanned state if given.
+        """
+        state = state or {}
+        with self.connection:
+            for zip_filename in zip_filenames:
+                archive = os.path.basename(zip_filename)
+                for table in ("files", "deleted", "errors"):
+                    self.connection.execute(
+                        "DELETE FROM {} WHERE snapshot = ? AND "
+                        "archive = ?".format(table), (snapshot, archive))
+                with zipfile.ZipFile(zip_filename) as zip_file:
+                    manifest = loads(zip_file.read(MANIFEST_FILENAME).decode(
+                        "utf-8"))
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO archives VALUES "
+                        "(?, ?, ?, ?, ?, ?)", (
+                            snapshot, origin, archive, manifest["type"],
+                            manifest.get("base"),
+                            os.path.getsize(zip_filename)))
+                    self.connection.executemany(
+                        "INSERT INTO deleted VALUES (?, ?, ?, ?)",
+                        [(snapshot, origin, path, archive)
+                         for path in manifest.get("deleted", [])])
+                    self.connection.executemany(
+                        "INSERT INTO errors VALUES (?, ?, ?, ?, ?)",
+                        [(snapshot, origin, path, archive, reason) for
+                         path, reason in manifest.get("errors", {}).items()])
+                    pieces = manifest.get("pieces", {})
+                    rows = []
+                    for info in zip_file.infolist():
+                        if info.filename == MANIFEST_FILENAME:
+                            continue
+                        piece = pieces.get(info.filename)
+                        size, mtime, checksum = state.get(info.filename) or (
+                            piece[2] if piece else info.file_size,
+                            int(time.mktime(info.date_time + (0, 0, -1))),
+                            None)
+                        rows.append((
+                            snapshot, origin, info.filename, size, mtime,
+                            info.CRC, checksum, archive, info.header_offset,
+                            info.compress_type, info.compress_size,
+                            piece[0] if piece else 0, info.file_size))
+                self.connection.executemany(
+                    "INSERT INTO files VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute(  # pieces of files that failed later on
+                "DELETE FROM files WHERE snapshot = ? AND origin = ? AND "
+                "path IN (SELECT path FROM errors WHERE snapshot = ? AND "
+                "origin = ?)", (snapshot, origin, snapshot, origin))
+
+    def add_snapshot(self, snapshot):
+        """Add every ZIP volume of snapshot, then mark it as cataloged.
+
+        ZIPs without a manifest, made by older Vacap versions, are added as
+        a single archive of type legacy, origin is the name of the ZIP.
+        """
+        snapshot_folder = os.path.join(self.folder, snapshot)
+        for filename in sorted(os.listdir(snapshot_folder)):
+            if filename.endswith(".zip"):
+                zip_filename = os.path.join(snapshot_folder, filename)
+                manifest = read_manifest(zip_filename)
+                if manifest is None and zipfile.is_zipfile(zip_filename):
+                    self.add_legacy(snapshot, zip_filename)
+                elif manifest is None:  # broken, try again next time
+                    log.warning("Cant catalog {}.".format(zip_filename))
+                    return
+                else:
+                    self.add_volumes(snapshot, manifest["origin"],
+                                     [zip_filename])
+        self.mark_snapshot(snapshot)
+
+    def add_legacy(self, snapshot, zip_filename):
+        """Add zip_filename, a ZIP without manifest, only its size."""
+        log.info("Cataloging legacy ZIP {}.".format(zip_filename))
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)", (
+                    snapshot, os.path.splitext(os.path.basename(
+                        zip_filename))[0], os.path.basename(zip_filename),
+                    "legacy", None, os.path.getsize(zip_filename)))
+
+    def mark_snapshot(self, snapshot):
+        """Mark snapshot as completely cataloged."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO snapshots VALUES (?)", (snapshot, ))
+
+    def remove_snapshots(self, snapshots):
+        """Forget every file of snapshots, on a single transaction."""
+        names = [(snapshot, ) for snapshot in snapshots]
+        with self.connection:
+            for table in ("files", "archives", "deleted", "errors"):
+                self.connection.executemany(
+                    "DELETE FROM {} WHERE snapshot = ?".format(table), names)
+            self.connection.executemany(
+                "DELETE FROM snapshots WHERE name = ?", names)
+
+    def update(self):
+        """Add the snapshots on folder that are not cataloged yet.
+
+        The snapshot of a killed run is left alone, it is added when resumed.
+        """
+        cataloged = {row["name"] for row in self.connection.execute(
+            "SELECT name FROM snapshots WHERE name IN "
+            "(SELECT snapshot FROM archives)")}  # older catalogs lack them
+        cataloged.add(load_journal(self.folder).get("snapshot"))
+        for snapshot in list_snapshots(self.folder):
+            if snapshot not in cataloged:
+                log.info("Cataloging Snapshot {}.".format(snapshot))
+                self.add_snapshot(snapshot)
+
+    def get_archives(self):
+        """Return the sizes, needs and origins of the cataloged snapshots.
+
+        As {snapshot: Bytes}, {snapshot: snapshots it needs} and {snapshot:
+        origins it holds}, an incremental needs its base, and so on.
+        """
+        self.update()
+        sizes, needs, origins = {}, {}, {}
+        for row in self.connection.execute("SELECT * FROM archives"):
+            sizes[row["snapshot"]] = sizes.get(row["snapshot"], 0) + (
+                row["size"])
+            origins.setdefault(row["snapshot"], set()).add(row["origin"])
+            if row["type"] != "full" and row["base"]:
+                needs.setdefault(row["snapshot"], set()).add(row["base"])
+        return sizes, needs, origins
+
+    def files(self, snapshot, origin=None):
+        """Return the rows of files stored on snapshot, of origin if given."""
+        self.update()
+        return self.connection.execute(
+            "SELECT * FROM files WHERE snapshot = ? AND (? IS NULL OR "
+            "origin = ?) ORDER BY origin, path, piece_offset",
+            (snapshot, origin, origin)).fetchall()
+
+    def errors(self, snapshot):
+        """Return the rows of files that failed to be stored on snapshot."""
+        self.update()
+        return self.connection.execute(
+            "SELECT * FROM errors WHERE snapshot = ? ORDER BY origin, path",
+            (snapshot, )).fetchall()
+
+    def find(self, pattern, origin=None, snapshot=None):
+        """Return the rows of files whose path or name matches glob pattern."""
+        self.update()
+        return self.connection.execute(
+            "SELECT * FROM files WHERE (fnmatch(path, ?) OR "
+            "fnmatch(path, ?)) AND (? IS NULL OR origin = ?) AND "
+            "(? IS NULL OR snapshot = ?) "
+            "ORDER BY snapshot, origin, path, piece_offset",
+            (pattern, "*/" + pattern, origin, origin, snapshot,
+             snapshot)).fetchall()
+
+    def chain(self, origin, snapshot=None):
+        """Return the snapshots of origin restored at snapshot, newest first.
+
+        The newest snapshot of origin at or before snapshot, its base, the
+        base of its base, and so on until the full one.
+        """
+        row = self.connection.execute(
+            "SELECT snapshot, type, base FROM archives WHERE origin = ? AND "
+            "(? IS NULL OR snapshot <= ?) ORDER BY snapshot DESC LIMIT 1",
+            (origin, snapshot, snapshot)).fetchone()
+        chain = []
+        while row is not None and row["snapshot"] not in chain:
+            chain.append(row["snapshot"])
+            if row["type"] == "full" or not row["base"]:
+                break
+            row = self.connection.execute(
+                "SELECT snapshot, type, base FROM archives WHERE origin = ? "
+                "AND snapshot = ?", (origin, row["base"])).fetchone()
+        return chain
+
+    def lookup(self, origin, path, snapshot=None):
+        """Return the rows of the copy of path restored at snapshot.
+
+        Only looks on the chain of snapshot, the last full plus its
+        incrementals. Several rows when the file was split on pieces between
+        volumes, FileNotFoundError if it was deleted before snapshot.
+        """
+        self.update()
+        for name in self.chain(origin, snapshot):
+            if self.connection.execute(
+                    "SELECT 1 FROM deleted WHERE snapshot = ? AND origin = ? "
+                    "AND path = ?", (name, origin, path)).fetchone():
+                raise FileNotFoundError("{} was deleted from {} on {}.".format(
+                    path, origin, name))
+            rows = self.connection.execute(
+                "SELECT * FROM files WHERE origin = ? AND path = ? AND "
+                "snapshot = ? ORDER BY piece_offset",
+                (origin, path, name)).fetchall()
+            if rows:
+                return rows
+        return []
+
+
+def read_zip_entry(folder, row, output=None, throttle=None):
+    """Read 1 catalog row from its ZIP on folder, check CRC, write to output.
+
+    Seeks straight to the local header of the entry, so the rest of the ZIP
+    and its central directory are never read, the codecs without a stable
+    API (lzma, zstd) fall back to zipfile.
+    """
+    zip_filename = os.path.join(folder, row["snapshot"], row["archive"])
+    checksum = 0
+    if row["compress_type"] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED,
+                                    zipfile.ZIP_BZIP2):
+        with zipfile.ZipFile(zip_filename) as zip_file, zip_file.open(
+                row["path"]) as entry:
+            for data in iter(lambda: entry.read(CHECKSUM_CHUNK_SIZE), b""):
+                checksum = zlib.crc32(data, checksum)
+                if output:
+                    output.write(data)
+    else:
+        decompressor = {zipfile.ZIP_DEFLATED: lambda: zlib.decompressobj(-15),
+                        zipfile.ZIP_BZIP2: bz2.BZ2Decompressor}.get(
+                            row["compress_type"], lambda: None)()
+        with open(zip_filename, "rb") as zip_file:
+            zip_file.seek(row["header_offset"])
+            header = LOCAL_HEADER.unpack(zip_file.read(LOCAL_HEADER.size))
+            if header[0] != b"PK\x03\x04":
+                raise ValueError("Bad local header.")
+            zip_file.seek(header[-2] + header[-1], os.SEEK_CUR)
+            remaining = row["compress_size"]
+            while remaining > 0:
+                data = zip_file.read(min(remaining, CHECKSUM_CHUNK_SIZE))
+                if not data:
+                    break
+                if throttle:
+                    throttle.read(len(data))
+                remaining -= len(data)
+                if decompressor:
+                    data = decompressor.decompress(data)
+                checksum = zlib.crc32(data, checksum)
+                if output:
+                    output.write(data)
+    if checksum != row["crc"]:
+        raise ValueError("CRC mismatch, data is corrupt.")
+
+
+def restore_files(folder, origin, paths, target, snapshot=None):
+    """Restore only paths of origin into target, from their newest copies."""
+    catalog = Catalog(folder)
+    try:
+        for relative in paths:
+            rows = catalog.lookup(origin, relative, snapshot)
+            if not rows:
+                raise FileNotFoundError("No backup of {} on {}.".format(
+                    relative, origin))
+            path = os.path.join(target, *relative.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as restored_file:
+                for row in rows:  # pieces come in order
+                    restored_file.seek(row["piece_offset"])
+                    try:
+                        read_zip_entry(folder, row, restored_file)
+                    except ValueError as reason:
+                        raise ValueError("{}: {}: {}".format(
+                            row["archive"], relative, reason))
+            os.utime(path, (rows[0]["mtime"], rows[0]["mtime"]))
+            log.info("Restored {} from {} into {}.".format(
+                relative, rows[0]["snapshot"], path))
+    finally:
+        catalog.close()
+
+
+def get_free_space_on_disk(folder):
+    """Return folder/drive free space (in Bytes)."""
+    if not os.path.isdir(folder):
+        return 0
+    else:
+        return shutil.disk_usage(folder).free
+
+
+def get_zip_filename(folder, origin, used):
+    """Return an unique ZIP filename on folder for origin, not in used."""
+    name = os.path.basename(os.path.normpath(origin)) or "backup"
+    zip_filename, count = os.path.join(folder, name + ".zip"), 1
+    while zip_filename in used or os.path.exists(zip_filename):
+        count += 1
+        zip_filename = os.path.join(folder, "{}_{}.zip".format(name, count))
+    used.add(zip_filename)
+    return zip_filename
+
+
 def get_free_space_on_disk_on_gb(folder):
     """Return folder/drive free space (in GigaBytes)."""
     if not os.path.isdir(folder):
@@ -193,125 +2337,288 @@ def add_to_startup():
         log.debug("BAT file already exists.")
 
 
-class Backuper(QProgressDialog):
+@contextmanager
+def locked(folder):
+    """Hold an exclusive lock on folder, OSError if another run holds it.
+
+    The operating system drops the lock if the process dies, so a stale
+    lock file never blocks the next run.
+    """
+    lock_file = open(os.path.join(folder, LOCK_FILENAME), "a+b")
+    try:
+        try:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            raise OSError("{} is in use by another Vacap run.".format(folder))
+        yield
+    finally:
+        lock_file.close()  # closing the file releases the lock
+
+
+@contextmanager
+def lock_destination(destination, mode=None):
+    """Lock the destination folder, and the dedup repository if any.
 
-    """Backuper Dialog with complete informations and progress bar."""
+    A gc deleting packs that a running backup has not indexed yet, or 2
+    backups writing the same index, would lose data.
+    """
+    with locked(destination):
+        if (mode or config["REPOSITORY_MODE"]) != "dedup":
+            yield
+            return
+        repository_folder = os.path.join(destination, REPOSITORY_FOLDER)
+        if not os.path.isdir(repository_folder):
+            os.makedirs(repository_folder)
+        with locked(repository_folder):
+            yield
 
-    def __init__(self, destination, origins, parent=None):
+
+class BackupEngine(object):
+
+    """Backup engine without GUI, reports progress using a callback.
+
+    progress(current_folder, done_bytes, total_bytes) is called from the
+    thread running the engine, at most a few times per second.
+    """
+
+    def __init__(self, destination, origins, progress=None):
         """Init class."""
-        super(Backuper, self).__init__(parent)
-        self.setWindowTitle(__doc__)
-        self.setWindowIcon(
-            QIcon(QApplication.style().standardPixmap(QStyle.SP_DriveFDIcon)))
-        self.setWindowFlags(Qt.FramelessWindowHint)
-        self.setCancelButton(None)
-        self._time, self._date = time.time(), datetime.now().isoformat()[:-7]
         self.destination, self.origins = destination, origins
-        self.template = """<h3>Copia de Seguridad BackUp</h3><hr><table>
-        <tr><td><b>Desde:</b></td>      <td>{}</td>
-        <tr><td><b>Hacia:  </b></td>      <td>{}</td> <tr>
-        <tr><td><b>Tiempo de Inicio:</b></td>   <td>{}</td>
-        <tr><td><b>Tiempo Actual:</b></td>    <td>{}</td> <tr>
-        <tr><td><b>Tiempo Transcurrido:</b></td>   <td>{}</td>
-        <tr><td><b>Faltante:</b></td> <td>{}</td> <tr>
-        <tr><td><b>Porcentaje:</b></td>     <td>{}%</td></table><hr>
-        <i>Por favor no toque nada hasta que termine, proceso trabajando</i>"""
-        self.setStyleSheet(CSS_STYLE)
-        self.show()
-        self.center()
-        self.setValue(0)
-        self.setLabelText(self.template)
-        self.make_backup()
-
-    def center(self):
-        """Center the Window on Current Screen,with MultiMonitor support."""
-        window_geometry = self.frameGeometry()
-        mousepointer_position = QApplication.desktop().cursor().pos()
-        screen = QApplication.desktop().screenNumber(mousepointer_position)
-        centerPoint = QApplication.desktop().screenGeometry(screen).center()
-        window_geometry.moveCenter(centerPoint)
-        self.move(window_geometry.topLeft())
-
-    def closeEvent(self, event):
-        """Force NO Quit."""
-        return event.ignore()
-
-    def seconds_time_to_human_str(self, time_on_seconds=0):
-        """Calculate time, with precision from seconds to days."""
-        minutes, seconds = divmod(int(time_on_seconds), 60)
-        hours, minutes = divmod(minutes, 60)
-        days, hours = divmod(hours, 24)
-        human_time_string = ""
-        if days:
-            human_time_string += "%02d Dias " % days
-        if hours:
-            human_time_string += "%02d Horas " % hours
-        if minutes:
-            human_time_string += "%02d Minutos " % minutes
-        human_time_string += "%02d Segundos" % seconds
-        return human_time_string
+        self.backup_root = os.path.dirname(destination)  # index lives here
+        self.progress = progress or (lambda *args: None)
+        self.total_bytes, self.done_bytes, self.profiles = {}, {}, 0
+        self.throttle, self.copier, self.copies = None, None, []
+        self.report = RunReport(
+            snapshot=os.path.basename(destination), origins=list(origins),
+            destination=self.backup_root, mode=config["REPOSITORY_MODE"])
 
     def make_backup(self):
-        """Try to make backups."""
-        self.make_zip()
-
-    def move_zip(self, filename):
-        """Try to move ZIP file to final destination."""
-        log.info("Checking if {} has Free Space.".format(self.destination))
-        free_space_on_disk = get_free_space_on_disk_on_gb(self.destination)
-        size_of_the_zip_file = int(os.stat(filename).st_size
-                                   / 1024 / 1024 / 1024)
-        log.info("Free Space: ~{} GigaBytes.".format(free_space_on_disk))
-        log.info("Size of ZIP: ~{} GigaBytes.".format(size_of_the_zip_file))
-        if free_space_on_disk > size_of_the_zip_file:
-            log.info("Copying to destination: {}".format(self.destination))
-            stored_zip_file = shutil.move(filename, self.destination)
-            log.info("ZIP file archived as {}.".format(stored_zip_file))
+        """Make backups holding the destination lock, then save the report."""
+        make = self.make_dedup if (
+            config["REPOSITORY_MODE"] == "dedup") else self.make_zip
+        try:
+            with lock_destination(self.backup_root):
+                self.clean_destination()
+                if config["PROFILE_RUN"]:
+                    tracemalloc.start()
+                    profiled_call(self.get_profile_filename(), make)
+                else:
+                    make()
+        except OSError as reason:  # the lock, make catches its own errors
+            log.critical(reason)
+            self.report.count("errors")
+        finally:  # no tracing if the lock or clean_destination failed
+            if config["PROFILE_RUN"] and tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1]
+                top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+                tracemalloc.stop()
+                self.report.info["tracemalloc"] = {
+                    "peak_bytes": peak, "top": [str(stat) for stat in top]}
             try:
-                log.info("Generating SHA1 Checksum *.BAT hidden file.")
-                self.generate_checksum(stored_zip_file)
-            except Exception as reason:
+                self.report.save(os.path.join(self.backup_root,
+                                              REPORT_FILENAME))
+            except OSError as reason:
                 log.warning(reason)
-        else:
-            log.critical("No Free Space on Backup Destination folder.")
 
-    def generate_checksum(self, filename):
-        """Generate a checksum using SHA1."""
+    def clean_destination(self):
+        """Remove orphans and expired snapshots, before the backup.
+
+        Runs here, on the thread of the engine holding the lock, never on the
+        GUI thread. The temporary folder fallback is never cleaned.
+        """
+        if os.path.normcase(os.path.realpath(self.backup_root)) == (
+                os.path.normcase(os.path.realpath(gettempdir()))):
+            return
+        with self.report.stage("retention"):
+            clean_orphans(self.backup_root)
+            try:
+                apply_retention(self.backup_root,
+                                current=os.path.basename(self.destination))
+            except Exception as reason:  # never skip a backup because of this
+                log.warning("Retention failed: {}.".format(reason))
+
+    def get_profile_filename(self):
+        """Return a new cProfile stats filename on the temporary folder."""
+        self.profiles += 1
+        return os.path.join(gettempdir(), "vacap_{}_{}.prof".format(
+            self.report.info["snapshot"], self.profiles))
+
+    def submit(self, executor, function, *args):
+        """Submit function to executor, under cProfile if PROFILE_RUN."""
+        if config["PROFILE_RUN"]:
+            return executor.submit(profiled_call, self.get_profile_filename(),
+                                   function, *args)
+        return executor.submit(function, *args)
+
+    def generate_checksum(self, filename, checksum=None):
+        """Generate a checksum using the configured algorithm, in chunks.
+
+        checksum is the one hashed while writing the ZIP, if any.
+        """
         log.info("Making {} Read-Only.".format(filename))
         os.chmod(filename, S_IREAD)
-        with open(filename, "rb") as zip_file:
-            checksum = sha1(zip_file.read()).hexdigest()
-            log.info("SHA1 Checksum: {}".format(checksum))
+        algorithm = get_checksum_algorithm()
+        if checksum is None:  # ZIPs of older versions, when resuming
+            checksum = hash_file(filename, algorithm, CHECKSUM_CHUNK_SIZE,
+                                 self.throttle)
+        log.info("{} Checksum: {}".format(algorithm.upper(), checksum))
+        if algorithm in ("sha1", "sha256"):  # certutil only knows SHA family
+            verify = 'certutil -hashfile "{}" {}'.format(filename,
+                                                         algorithm.upper())
+        else:
+            verify = ('python -c "import hashlib;h=hashlib.new(\'{}\');'
+                      "f=open(r'{}','rb');[h.update(b) for b in "
+                      "iter(lambda:f.read({}),b'')];print(h.hexdigest())\""
+                      ).format(algorithm, filename, CHECKSUM_CHUNK_SIZE)
         checksum_file = filename + ".bat"
         with open(checksum_file, "w") as checksum_filename:
             checksum_filename.write("""@echo off
-                echo Valid SHA1 Checksum: {}
-                certutil -hashfile "{}" SHA1""".format(checksum, filename))
-        log.info("Making SHA1 Checksum *.BAT {} Hidden".format(checksum_file))
-        ctypes.windll.kernel32.SetFileAttributesW(checksum_file,
-                                                  0x02)  # make hidden file
+                echo Valid {} Checksum: {}
+                {}""".format(algorithm.upper(), checksum, verify))
+        if sys.platform.startswith("win"):  # only Windows has windll
+            log.info("Making Checksum *.BAT {} Hidden".format(checksum_file))
+            ctypes.windll.kernel32.SetFileAttributesW(checksum_file,
+                                                      0x02)  # hidden file
         log.info("Making {} Read-Only.".format(checksum_file))
         os.chmod(checksum_file, S_IREAD)
 
+    def report_progress(self, events, current):
+        """Drain progress events from worker processes, then report them."""
+        try:
+            while True:
+                kind, folder, size = events.get_nowait()
+                if kind == "total":
+                    self.total_bytes[folder] = size
+                elif kind == "volume":  # size is the finished ZIP filename
+                    if config["COPY_VOLUMES_TO"] and self.copier:
+                        self.copies.append(self.copier.submit(
+                            copy_volume, size, config["COPY_VOLUMES_TO"],
+                            os.path.basename(self.destination)))
+                else:
+                    self.done_bytes[folder] = self.done_bytes.get(
+                        folder, 0) + size
+        except Empty:
+            pass
+        self.progress(current, sum(self.done_bytes.values()),
+                      sum(self.total_bytes.values()))
+
     def make_zip(self):
-        """Try to make a ZIP file."""
+        """Try to make ZIP files, 1 per origin folder, on a process pool."""
         try:
-            # iterate over lists of folders to backup
-            for folder_to_backup in self.origins:
-                percentage = int(self.origins.index(folder_to_backup) /
-                                 len(self.origins) * 100)
-                self.setLabelText(self.template.format(
-                    folder_to_backup[:99], self.destination.lower()[:99],
-                    self._date, datetime.now().isoformat()[:-7],
-                    self.seconds_time_to_human_str(time.time() - self._time),
-                    len(self.origins) - self.origins.index(folder_to_backup),
-                    percentage))
-                self.setValue(percentage)
-                QApplication.processEvents()  # Forces the UI to Update
-                log.info("Folder to backup: {}.".format(folder_to_backup))
-                shutil.make_archive(folder_to_backup, "zip",
-                                    folder_to_backup, logger=log)
-                self.move_zip(folder_to_backup + ".zip")
+            incremental = config["MAKE_INCREMENTAL_BACKUPS"]
+            index = load_index(self.backup_root) if incremental else None
+            max_workers = get_max_workers(len(self.origins))
+            options = get_worker_options(max_workers)
+            self.throttle = Throttle(options, max_workers, self.report)
+            log.info("Compressing on {} worker processes.".format(max_workers))
+            journal_filename = os.path.join(self.backup_root,
+                                            JOURNAL_FILENAME)
+            snapshot = os.path.basename(self.destination)
+            journal = load_journal(self.backup_root)
+            if journal.get("snapshot") != snapshot:
+                journal = {"snapshot": snapshot, "zips": {}, "done": []}
+            catalog, cataloged = Catalog(self.backup_root), True
+            with Manager() as manager, ProcessPoolExecutor(
+                    max_workers, initializer=lower_process_priority,
+                    initargs=(config["IO_PRIORITY"], )) as executor, (
+                        ThreadPoolExecutor(1)) as self.copier:
+                events, pending, failed = manager.Queue(), {}, []
+                reservations = manager.Value("q", 0), manager.Lock()
+                used = {os.path.join(self.destination, name)
+                        for name in journal["zips"].values()}
+                # iterate over lists of folders to backup
+                for folder_to_backup in self.origins:
+                    if folder_to_backup in journal["done"]:
+                        log.info("Already done {}, resuming.".format(
+                            folder_to_backup))
+                        continue
+                    log.info("Folder to backup: {}.".format(folder_to_backup))
+                    entry = index["origins"].get(folder_to_backup) if (
+                        incremental) else None
+                    zip_filename = os.path.join(
+                        self.destination, journal["zips"][folder_to_backup]
+                    ) if folder_to_backup in journal["zips"] else (
+                        get_zip_filename(self.destination, folder_to_backup,
+                                         used))
+                    journal["zips"][folder_to_backup] = os.path.basename(
+                        zip_filename)
+                    pending[self.submit(
+                        executor, archive_folder, folder_to_backup,
+                        zip_filename, entry, options, events,
+                        reservations)] = folder_to_backup
+                save_json(journal_filename, journal)
+                current = ", ".join(pending.values())
+                while pending:  # stream results back as soon as they finish
+                    finished, _ = wait(pending, timeout=0.25,
+                                       return_when=FIRST_COMPLETED)
+                    self.report_progress(events, current)
+                    for future in finished:
+                        folder_to_backup = current = pending.pop(future)
+                        try:
+                            zip_filenames, checksums, state, full, report = (
+                                future.result())
+                        except Exception as reason:
+                            log.warning("Failed {}: {}.".format(
+                                folder_to_backup, reason))
+                            self.report.count("errors")
+                            failed.append(folder_to_backup)
+                            continue
+                        self.report.merge(folder_to_backup, report)
+                        for zip_filename, checksum in zip(zip_filenames,
+                                                          checksums):
+                            if os.path.isfile(zip_filename + ".bat"):
+                                continue  # checksum done before resuming
+                            log.info("ZIP file archived as {}.".format(
+                                zip_filename))
+                            try:
+                                log.info("Generating Checksum *.BAT file.")
+                                with self.report.stage("checksum"):
+                                    self.generate_checksum(zip_filename,
+                                                           checksum)
+                            except Exception as reason:
+                                log.warning(reason)
+                        if incremental and zip_filenames:  # ZIP is stored
+                            entry = index["origins"].get(folder_to_backup)
+                            index["origins"][folder_to_backup] = {
+                                "files": state,
+                                "snapshot": snapshot,
+                                "incrementals": 0 if full else (
+                                    entry["incrementals"] + 1)}
+                            with self.report.stage("index"):
+                                save_index(self.backup_root, index)
+                        try:
+                            with self.report.stage("catalog"):
+                                catalog.add_volumes(
+                                    snapshot, folder_to_backup, zip_filenames,
+                                    state)
+                        except Exception as reason:  # rebuilt when needed
+                            log.warning(reason)
+                            cataloged = False
+                        journal["done"].append(folder_to_backup)
+                        save_json(journal_filename, journal)
+                        segment_journal = os.path.join(
+                            self.destination, journal["zips"][
+                                folder_to_backup] + SEGMENT_JOURNAL)
+                        if os.path.isfile(segment_journal):
+                            os.remove(segment_journal)
+                self.report_progress(events, current)
+                with self.report.stage("copy"):
+                    for copy in self.copies:  # removable media may be slow
+                        try:
+                            copy.result()
+                        except Exception as reason:
+                            log.warning(reason)
+                            self.report.count("errors")
+                for folder_to_backup in failed:  # the next run starts over
+                    self.remove_volumes(journal["zips"][folder_to_backup])
+            if cataloged:
+                catalog.mark_snapshot(snapshot)
+            catalog.close()
+            os.remove(journal_filename)  # only kept if the run was killed
         except Exception as reason:
             log.warning(reason)
         else:
@@ -320,140 +2627,812 @@ class Backuper(QProgressDialog):
             log.info("Finished BackUp from {} to {}.".format(
                 self.origins, self.destination))
 
+    def remove_volumes(self, zip_name):
+        """Remove the volumes of an origin that failed, it is left out.
 
-##############################################################################
-
+        A half backup would restore only some files, the index still points
+        to the previous snapshot, so the next run stores it again.
+        """
+        zip_filename = os.path.join(self.destination, zip_name)
+        filenames, number = [zip_filename + SEGMENT_JOURNAL], 1
+        while any(os.path.isfile(get_segment_filename(
+                zip_filename, number) + suffix) for suffix in ("", ".part")):
+            for suffix in ("", ".bat", ".part"):
+                filenames.append(get_segment_filename(zip_filename, number) +
+                                 suffix)
+            number += 1
+        for filename in filenames:
+            if os.path.isfile(filename):
+                log.info("Removing volume of failed origin {}.".format(
+                    filename))
+                try:
+                    os.chmod(filename, S_IWRITE)  # checksums are read only
+                    os.remove(filename)
+                except OSError as reason:
+                    log.warning(reason)
 
-class MainWindow(QSystemTrayIcon):
-
-    """Main widget for Vacap, not really a window since not needed."""
-
-    def __init__(self, icon, parent=None):
-        """Tray icon main widget."""
-        super(MainWindow, self).__init__(icon, parent)
-        log.info("Iniciando el programa Vacap...")
-        global config
-        get_or_set_config()
-        self.origins = config["MAKE_BACKUP_FROM"]
-        self.destination = config["SAVE_BACKUP_TO"]
-        self.setToolTip(__doc__ + "\n1 Click y 'Hacer Backup'!")
-        self.traymenu = QMenu("Backup")
-        self.traymenu.setIcon(icon)
-        self.traymenu.addAction(icon, "Hacer Backup", lambda: self.backup())
-        self.traymenu.setFont(QFont("Verdana", 10, QFont.Bold))
-        self.setContextMenu(self.traymenu)
-        self.activated.connect(self.click_trap)
-        self.contextMenu().setStyleSheet(CSS_STYLE)
-        add_to_startup()
-        log.info("Inicio el programa Vacap.")
-        self.show()
-        self.showMessage("Vacap", "Copia de Seguridad Backup funcionando.")
-        if config["MAKE_BACKUP_ON_STARTUP"]:
-            log.info("Running Backup on Start-Up.")
-            self.backup()
-        if config["MAKE_BACKUP_AT_THIS_HOUR"]:
-            log.info("Running Automatic Backup by Scheduled Hours.")
-            self.timer = QTimer(self)
-            self.timer.timeout.connect(self.run_backup_by_hour)
-            self.timer.start(3600000)  # 1 Hour on Milliseconds
-
-    def click_trap(self, value):
-        """Trap the mouse tight click."""
-        if value == self.Trigger:  # left click
-            self.traymenu.exec_(QCursor.pos())
-
-    def run_backup_by_hour(self):
-        """Run Automatic Backup if the actual Hour equals Scheduled Hour."""
-        if int(datetime.now().hour) == int(config["MAKE_BACKUP_AT_THIS_HOUR"]):
-            log.info("Running Automatic Backup by Scheduled Hour.")
-            _day = day_name[datetime.today().weekday()].lower()
-            if config["MAKE_BACKUP_ON_WEEK_DAY"] != _day:
-                log.info("Skipping Automatic Backup by Scheduled Week Day.")
-                return  # if backup on weeke day not equals today, then return
-            self.backup()
-
-    def check_destination_folder(self):
-        """Check destination folder."""
-        log.info("Checking destination folder {}.".format(self.destination))
-        # What if destination folder been removed.
-        if not os.path.isdir(self.destination):
-            log.critical("Folder {} does not exist, saving to {}!.".format(
-                self.destination, gettempdir()))
-            self.destination = gettempdir()
-        # What if destination folder is not Writable by the user.
-        if not os.access(self.destination, os.W_OK):
-            log.critical("Folder {} permission denied (Not Writable).".format(
-                self.destination))
-            self.destination = gettempdir()
-        # get date and time for folder name
-        t = datetime.now().isoformat().lower().split(".")[0].replace(":", "_")
-        # prepare a new folder with date-time inside destination folder
-        log.info("Folder {} is OK for BackUp.".format(self.destination))
-        self.destination = os.path.join(self.destination, t)
-        if not os.path.isdir(self.destination):
-            os.mkdir(self.destination)
-            log.info("Created New Folder {}.".format(self.destination))
-
-    def check_origins_folders(self):
-        """Check origin folders."""
-        log.info("Checking origins folders {}.".format(self.origins))
-        # remove repeated items if any
-        self.origins = list(set(self.origins))
-        for folder_to_check in self.origins:
-            # if folder is not a folder
-            if not os.path.isdir(folder_to_check):
-                log.critical("Folder {} dont exist.".format(folder_to_check))
-                self.origins.remove(folder_to_check)
-            # if folder is not readable
-            elif not os.access(folder_to_check, os.R_OK):
-                log.critical("Folder {} not Readable.".format(folder_to_check))
-                self.origins.remove(folder_to_check)
-            else:  # folder is ok
-                log.info("Folder {} is OK to BackUp.".format(folder_to_check))
-        return bool(len(self.origins))
-
-    def backup(self):
-        """Backup desde MAKE_BACKUP_FROM hacia SAVE_BACKUP_TO."""
-        if not config["MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY"]:
-            if windows_is_running_on_battery():  # if is windows on battery ?
-                return  # if on battery and should not make backup, then return
-        self.contextMenu().setDisabled(True)
-        self.check_destination_folder()
-        if self.check_origins_folders():
-            log.info("Starting to BackUp folders...")
-            Backuper(destination=self.destination, origins=self.origins)
-            self.contextMenu().setDisabled(False)
-            self.showMessage("Vacap", "Copia de Seguridad Backup Termino bien")
+    def make_dedup(self):
+        """Try to make a snapshot on the deduplicated repository."""
+        try:
+            max_workers = get_max_workers(len(self.origins))
+            options = get_worker_options(max_workers)
+            repository = DedupRepository(
+                os.path.join(self.backup_root, REPOSITORY_FOLDER), options)
+            snapshots = repository.list_snapshots()
+            latest = repository.load_snapshot(snapshots[-1])["origins"] if (
+                snapshots) else {}
+            log.info("Deduplicating on {} worker processes.".format(
+                max_workers))
+            with Manager() as manager, ProcessPoolExecutor(
+                    max_workers, initializer=lower_process_priority,
+                    initargs=(config["IO_PRIORITY"], )) as executor:
+                events, pending, origins = manager.Queue(), {}, {}
+                for folder_to_backup in self.origins:
+                    log.info("Folder to backup: {}.".format(folder_to_backup))
+                    pending[self.submit(
+                        executor, dedup_archive_folder, repository.folder,
+                        folder_to_backup, latest.get(folder_to_backup, {}),
+                        options, events)] = folder_to_backup
+                current = ", ".join(pending.values())
+                while pending:  # stream results back as soon as they finish
+                    finished, _ = wait(pending, timeout=0.25,
+                                       return_when=FIRST_COMPLETED)
+                    self.report_progress(events, current)
+                    for future in finished:
+                        folder_to_backup = current = pending.pop(future)
+                        try:
+                            files, new_chunks, report = future.result()
+                        except Exception as reason:
+                            log.warning("Failed {}: {}.".format(
+                                folder_to_backup, reason))
+                            self.report.count("errors")
+                            continue
+                        self.report.merge(folder_to_backup, report)
+                        origins[folder_to_backup] = files
+                        with self.report.stage("index"):
+                            repository.save(new_chunks)
+                self.report_progress(events, current)
+            if origins:
+                with self.report.stage("index"):
+                    repository.save_snapshot(
+                        os.path.basename(self.destination), origins)
+            if int(config["DEDUP_KEEP_SNAPSHOTS"]) > 0:
+                with self.report.stage("gc"):
+                    repository.prune(int(config["DEDUP_KEEP_SNAPSHOTS"]))
+                    repository.gc()
+        except Exception as reason:
+            log.warning(reason)
         else:
-            log.critical("Vacap is not properly configured, Exiting...")
-            sys.exit(1)
+            log.info("Copia de Seguridad Backup Termino bien.")
+        finally:
+            log.info("Finished Dedup BackUp from {} to {}.".format(
+                self.origins, self.backup_root))
+
+
+class CronSchedule(object):
+
+    """Cron expression "minute hour day month weekday", local time."""
+
+    def __init__(self, expression):
+        """Init class."""
+        self.expression = expression.strip()
+        fields = CRON_MACROS.get(self.expression, self.expression).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid Cron expression {}.".format(expression))
+        (self.minutes, self.hours, self.days, self.months,
+         self.week_days) = [self.parse_field(field, low, high) for field, (
+             low, high) in zip(fields, CRON_FIELDS)]
+        if 7 in self.week_days:  # 0 and 7 are both sunday
+            self.week_days = (self.week_days - {7}) | {0}
+        self.any_day, self.any_week_day = fields[2] == "*", fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, low, high):
+        """Parse 1 field like "*/15", "1-5", "mon,fri" into a set."""
+        values = set()
+        for part in field.lower().split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = low, high
+            else:
+                start, _, end = part.partition("-")
+                start = int(CRON_NAMES.get(start, start))
+                end = int(CRON_NAMES.get(end, end)) if end else (
+                    high if step else start)  # "5/10" means "5-max/10"
+            step = step or "1"
+            if not low <= start <= end <= high or int(step) < 1:
+                raise ValueError("Invalid Cron field {}.".format(field))
+            values.update(range(start, end + 1, int(step)))
+        return values
+
+    def match_day(self, when):
+        """Return True if the day of when matches, like cron does.
+
+        If both day and weekday are restricted, either one matching is OK.
+        """
+        day = when.day in self.days
+        week_day = (when.weekday() + 1) % 7 in self.week_days
+        if self.any_day or self.any_week_day:
+            return day and week_day
+        return day or week_day
+
+    def next_after(self, when):
+        """Return the exact next datetime after when that matches."""
+        when = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=366 * 5)
+        while when < limit:
+            if when.month not in self.months:  # jump to next month
+                when = (when.replace(day=1, hour=0, minute=0) +
+                        timedelta(days=32)).replace(day=1)
+            elif not self.match_day(when):  # jump to next day
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:  # jump to next hour
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError("Cron {} never matches.".format(self.expression))
+
+
+def get_schedules():
+    """Return schedules from config, fallback to the legacy hour and day."""
+    schedules = list(config["SCHEDULES"])
+    if not schedules and config.get("MAKE_BACKUP_AT_THIS_HOUR"):
+        week_day = str(config.get("MAKE_BACKUP_ON_WEEK_DAY", "*")).lower()
+        schedules.append({"cron": "0 {} * * {}".format(
+            int(config["MAKE_BACKUP_AT_THIS_HOUR"]),
+            WEEK_DAYS.get(week_day, week_day if week_day in CRON_NAMES else
+                          "*"))})
+    return schedules
+
+
+class Scheduler(object):
+
+    """Fire cron schedules at the exact time, catching up missed ones.
+
+    The last run of each schedule is persisted on SCHEDULE_FILENAME, so a
+    schedule missed while the computer was off or asleep is due at once
+    after boot or resume. Each fire time gets a random delay up to jitter
+    seconds, so many computers do not hit a shared destination at once.
+    Invalid or never matching schedules are logged and skipped.
+    """
+
+    def __init__(self, schedules, jitter=0, catch_up=True,
+                 state_filename=SCHEDULE_FILENAME):
+        """Init class."""
+        self.jitter, self.state_filename = jitter, state_filename
+        self.schedules, self.fire_times, self.state = {}, {}, {}
+        now, state = datetime.now(), {}
+        if os.path.isfile(state_filename):
+            try:
+                with open(state_filename, "r", encoding="utf-8") as _state:
+                    state = loads(_state.read())
+            except ValueError as reason:
+                log.warning(reason)
+        for schedule in schedules:
+            key = dumps(schedule, sort_keys=True)
+            try:  # a bad schedule on config must not stop the others
+                cron = CronSchedule(schedule["cron"])
+                cron.next_after(now)
+                self.schedules[key] = (cron, schedule.get("origins"))
+            except (AttributeError, KeyError, TypeError, ValueError) as error:
+                log.critical("Skipped Schedule {}: {}".format(key, error))
+                continue
+            # never run schedules start now, they have nothing to catch up
+            self.state[key] = state.get(key, now.strftime(SNAPSHOT_FORMAT))
+            last_run = datetime.strptime(self.state[key], SNAPSHOT_FORMAT)
+            self.set_fire_time(key, last_run if catch_up else now)
+
+    def set_fire_time(self, key, last_run):
+        """Compute next fire time of schedule key, after last_run."""
+        cron = self.schedules[key][0]
+        self.fire_times[key] = cron.next_after(last_run) + timedelta(
+            seconds=random.uniform(0, self.jitter) if self.jitter else 0)
+        log.info("Next Scheduled Backup for {} at {}.".format(
+            cron.expression, self.fire_times[key]))
+
+    def pop_due(self, now=None):
+        """Return origins of every due schedule and reschedule them.
+
+        Origins is None when a due schedule uses the default folders.
+        Several due schedules are merged, so they run as 1 single backup.
+        """
+        now, origins, due = now or datetime.now(), set(), False
+        for key, (cron, schedule_origins) in self.schedules.items():
+            if self.fire_times[key] > now:
+                continue
+            due = True
+            if schedule_origins is None:
+                origins = None
+            elif origins is not None:
+                origins.update(schedule_origins)
+            self.state[key] = now.strftime(SNAPSHOT_FORMAT)
+            self.set_fire_time(key, now)
+        if due:
+            save_json(self.state_filename, self.state)
+        return due, sorted(origins) if origins is not None else None
+
+    def seconds_to_next(self, now=None):
+        """Return seconds to sleep until next check, never too long."""
+        now = now or datetime.now()
+        if not self.fire_times:
+            return SCHEDULE_MAX_SLEEP
+        seconds = (min(self.fire_times.values()) - now).total_seconds()
+        return max(0, min(seconds, SCHEDULE_MAX_SLEEP))
+
+
+def check_destination_folder(destination):
+    """Check destination folder, return it and a new snapshot folder on it.
+
+    Falls back to the temporary folder if destination is missing or not
+    writable, the snapshot folder is not created for dedup repositories.
+    If a run was killed, returns its snapshot folder to resume it.
+    """
+    log.info("Checking destination folder {}.".format(destination))
+    # What if destination folder been removed.
+    if not os.path.isdir(destination):
+        log.critical("Folder {} does not exist, saving to {}!.".format(
+            destination, gettempdir()))
+        destination = gettempdir()
+    # What if destination folder is not Writable by the user.
+    if not os.access(destination, os.W_OK):
+        log.critical("Folder {} permission denied (Not Writable).".format(
+            destination))
+        destination = gettempdir()
+    # get date and time for folder name
+    t = datetime.now().strftime(SNAPSHOT_FORMAT)
+    # prepare a new folder with date-time inside destination folder,
+    # destination stays as is, the incremental index lives there.
+    log.info("Folder {} is OK for BackUp.".format(destination))
+    snapshot = os.path.join(destination, t)
+    resume = load_journal(destination).get("snapshot")
+    if config["REPOSITORY_MODE"] == "dedup":
+        return destination, snapshot
+    if resume and os.path.isdir(os.path.join(destination, resume)):
+        snapshot = os.path.join(destination, resume)
+        log.info("Resuming interrupted BackUp on {}.".format(snapshot))
+    elif not os.path.isdir(snapshot):
+        os.mkdir(snapshot)
+        log.info("Created New Folder {}.".format(snapshot))
+    return destination, snapshot
+
+
+def clean_orphans(destination):
+    """Remove temporary files left on destination by killed backup runs.
+
+    Only names that Vacap writes are touched: the *.tmp of the index and
+    journal JSONs, half written *.zip.part volumes and the *.zip journals
+    of segments, kept only on the snapshot that will be resumed. Expired
+    snapshots half deleted are deleted.
+    """
+    journal = load_journal(destination)
+    for name in os.listdir(destination) if os.path.isdir(destination) else ():
+        try:
+            datetime.strptime(name.rsplit(".deleting", 1)[0], SNAPSHOT_FORMAT)
+        except ValueError:
+            continue
+        if name.endswith(".deleting"):
+            log.info("Removing orphan {}.".format(name))
+            try:
+                shutil.rmtree(os.path.join(destination, name),
+                              onerror=remove_readonly)
+            except OSError as reason:
+                log.warning(reason)
+    orphans = [os.path.join(destination, INDEX_FILENAME + ".tmp"),
+               os.path.join(destination, JOURNAL_FILENAME + ".tmp"),
+               os.path.join(destination, REPOSITORY_FOLDER, "index.json.tmp")]
+    for name in list_snapshots(destination):
+        folder = os.path.join(destination, name)
+        for filename in os.listdir(folder):
+            if filename.endswith(".zip.part") or (
+                    filename.endswith(".zip" + SEGMENT_JOURNAL) and
+                    name != journal.get("snapshot")):
+                orphans.append(os.path.join(folder, filename))
+    for filename in orphans:
+        if os.path.isfile(filename):
+            log.info("Removing orphan {}.".format(filename))
+            try:
+                os.remove(filename)
+            except OSError as reason:
+                log.warning(reason)
+
+
+def get_retention_policy(options=None):
+    """Return the retention policy from options, default the config."""
+    options = options or config
+    return {"last": int(options["KEEP_LAST"]),
+            "daily": int(options["KEEP_DAILY"]),
+            "weekly": int(options["KEEP_WEEKLY"]),
+            "monthly": int(options["KEEP_MONTHLY"]),
+            "max_size": int(options["MAX_TOTAL_SIZE_MB"]) * 1024 * 1024}
+
+
+def select_expired(snapshots, policy, needs=None, measure=None,
+                   protected=(), origins=None):
+    """Return the snapshots expired by policy, oldest first.
+
+    Keeps the last N, the newest of each of the last N days, weeks and
+    months, then every snapshot a kept one needs (the base of incrementals).
+    If measure(kept) is bigger than max_size the oldest are expired too, with
+    the ones that need them. The newest and protected ones are always kept.
+    origins maps snapshots to the origins they hold, then the policy counts
+    the snapshots of each origin on its own, and a snapshot expires only if
+    it expired for every origin on it, the newest of each origin is kept.
+    """
+    needs, origins = needs or {}, origins or {}
+
+    def close(names):  # add what names need, recursively
+        names, pending = set(names), list(names)
+        while pending:
+            for base in needs.get(pending.pop(), ()):
+                if base not in names:
+                    names.add(base)
+                    pending.append(base)
+        return names
+
+    if not any(policy.values()) or not snapshots:
+        return []
+    groups = {}  # origin: its snapshots, oldest first
+    for name in snapshots:
+        for origin in origins.get(name) or (None, ):
+            groups.setdefault(origin, []).append(name)
+    always = close(set(protected) | {group[-1] for group in groups.values()})
+    keep = set(snapshots)
+    if policy["last"] or policy["daily"] or policy["weekly"] or (
+            policy["monthly"]):
+        keep = set(always)
+        for group in groups.values():
+            keep |= set(group[-policy["last"]:] if policy["last"] else ())
+            for rule, get_bucket in (
+                    ("daily", lambda when: when.date()),
+                    ("weekly", lambda when: when.isocalendar()[:2]),
+                    ("monthly", lambda when: (when.year, when.month))):
+                buckets = set()
+                for name in reversed(group):
+                    if len(buckets) >= policy[rule]:
+                        break
+                    bucket = get_bucket(datetime.strptime(
+                        name, SNAPSHOT_FORMAT))
+                    if bucket not in buckets:
+                        buckets.add(bucket)
+                        keep.add(name)
+        keep = close(keep)
+    if policy["max_size"] and measure:
+        for name in snapshots:
+            if measure(keep) <= policy["max_size"]:
+                break
+            if name in keep and name not in always:
+                keep -= {other for other in keep if name in close({other})}
+    return [name for name in snapshots if name not in keep]
+
+
+def remove_readonly(function, path, excinfo):
+    """Make path writable and try again, shutil.rmtree error handler."""
+    os.chmod(path, S_IWRITE)  # ZIPs and checksums are read-only
+    function(path)
+
+
+def apply_retention(destination, policy=None, dry_run=False, current=None):
+    """Remove the snapshots on destination expired by the retention policy.
+
+    Sizes and incremental chains come from the catalog (the manifests on
+    dedup mode), so no ZIP is opened. Expired folders are renamed first and
+    deleted after, a killed run leaves *.deleting folders for clean_orphans.
+    The current snapshot being written is not counted as a backup yet, it
+    and the ones on the index (the base of the next incremental) are kept
+    with their bases. Returns the names of the expired snapshots.
+    """
+    policy = policy or get_retention_policy()
+    if not any(policy.values()):
+        return []
+    if config["REPOSITORY_MODE"] == "dedup":
+        repository_folder = os.path.join(destination, REPOSITORY_FOLDER)
+        if not os.path.isdir(repository_folder):
+            return []
+        repository = DedupRepository(repository_folder)
+        chunks, origins = repository.get_chunks()
+
+        def measure(kept):
+            return sum(CHUNK_HEADER.size + repository.index[chunk_id][2]
+                       for chunk_id in set().union(*(
+                           chunks[name] for name in kept))
+                       if chunk_id in repository.index)
+
+        expired = select_expired(sorted(chunks), policy, measure=measure,
+                                 origins=origins)
+        log.info("Retention expired {} Dedup Snapshots.".format(len(expired)))
+        if expired and not dry_run:
+            repository.forget(expired)
+            repository.gc()
+        return expired
+    catalog = Catalog(destination)
+    try:
+        sizes, needs, origins = catalog.get_archives()
+
+        def measure(kept):
+            return sum(sizes.get(name, 0) for name in kept)
+
+        expired = select_expired(
+            [name for name in list_snapshots(destination) if name != current],
+            policy, needs, measure,
+            [current, load_journal(destination).get("snapshot")] + [
+                entry["snapshot"] for entry in load_index(
+                    destination)["origins"].values()], origins)
+        log.info("Retention expired {} Snapshots.".format(len(expired)))
+        if expired and not dry_run:
+            catalog.remove_snapshots(expired)
+    finally:
+        catalog.close()
+    if expired and not dry_run:
+        for name in expired:
+            os.rename(os.path.join(destination, name),
+                      os.path.join(destination, name + ".deleting"))
+        for name in expired:
+            log.info("Deleting expired Snapshot {}.".format(name))
+            shutil.rmtree(os.path.join(destination, name + ".deleting"),
+                          onerror=remove_readonly)
+    return expired
+
+
+def check_origins_folders(origins):
+    """Check origin folders, return the ones that are OK to backup."""
+    log.info("Checking origins folders {}.".format(origins))
+    checked_origins = []
+    for folder_to_check in sorted(set(origins)):  # remove repeated items
+        # if folder is not a folder
+        if not os.path.isdir(folder_to_check):
+            log.critical("Folder {} dont exist.".format(folder_to_check))
+        # if folder is not readable
+        elif not os.access(folder_to_check, os.R_OK):
+            log.critical("Folder {} not Readable.".format(folder_to_check))
+        else:  # folder is ok
+            log.info("Folder {} is OK to BackUp.".format(folder_to_check))
+            checked_origins.append(folder_to_check)
+    return checked_origins
+
+
+def verify_snapshot(folder, snapshot, sample=0, jobs=0):
+    """Verify the files of snapshot, return the list of failures.
+
+    Checks the CRC of every file (SHA256 of every chunk on dedup mode), or
+    of a random sample of files, on jobs threads, codecs release the GIL.
+    """
+    failures = []
+    if config["REPOSITORY_MODE"] == "dedup":
+        repository = DedupRepository(os.path.join(folder, REPOSITORY_FOLDER))
+        items = [(relative, chunk_ids) for files in repository.load_snapshot(
+            snapshot)["origins"].values() for relative, (
+                size, mtime, chunk_ids) in files.items()]
+
+        def check(item):
+            for chunk_id in item[1]:
+                repository.read_chunk(chunk_id)
+    else:
+        catalog = Catalog(folder)
+        try:
+            rows = catalog.files(snapshot)
+            for row in catalog.errors(snapshot):  # not stored, nothing to read
+                log.warning("{}: {}: not stored on this backup, {}.".format(
+                    row["archive"], row["path"], row["reason"]))
+        finally:
+            catalog.close()
+        snapshot_folder, archives = os.path.join(folder, snapshot), {
+            row["archive"] for row in rows}
+        for filename in sorted(os.listdir(snapshot_folder)):
+            zip_filename = os.path.join(snapshot_folder, filename)
+            if not filename.endswith(".zip") or filename in archives or (
+                    read_manifest(zip_filename) is not None):
+                continue
+            try:  # legacy ZIPs have no manifest, only their CRCs to check
+                with zipfile.ZipFile(zip_filename) as zip_file:
+                    bad_file = zip_file.testzip()
+            except (zipfile.BadZipFile, OSError):
+                failures.append("{}: unreadable ZIP".format(filename))
+            else:
+                if bad_file is not None:
+                    failures.append("{}: {}: bad CRC".format(filename,
+                                                             bad_file))
+        items = [("{}: {}".format(row["archive"], row["path"]), row)
+                 for row in rows]
+
+        def check(item):
+            read_zip_entry(folder, item[1])
+    if sample:
+        items = random.sample(items, min(int(sample), len(items)))
+    log.info("Verifying {} files of {}.".format(len(items), snapshot))
+    with ThreadPoolExecutor(int(jobs) or os.cpu_count() or 1) as executor:
+        for item, future in [(item, executor.submit(check, item))
+                             for item in items]:
+            try:
+                future.result()
+            except Exception as reason:
+                failures.append("{}: {}".format(item[0], reason))
+    return failures
+
+
+def find_files(folder, pattern="*", origin=None, snapshot=None):
+    """Return (snapshot, origin, path, size, mtime) of files matching pattern.
+
+    Only reads the catalog (the snapshot manifests on dedup mode), never the
+    archives. A pattern without wildcards matches any path that contains it.
+    """
+    if not any(char in pattern for char in "*?["):
+        pattern = "*" + pattern + "*"
+    if config["REPOSITORY_MODE"] != "dedup":
+        catalog = Catalog(folder)
+        try:
+            return [(row["snapshot"], row["origin"], row["path"], row["size"],
+                     row["mtime"]) for row in catalog.find(
+                         pattern, origin, snapshot) if not row["piece_offset"]]
+        finally:
+            catalog.close()
+    found = []
+    repository = DedupRepository(os.path.join(folder, REPOSITORY_FOLDER))
+    for name in repository.list_snapshots():
+        if snapshot and name != snapshot:
+            continue
+        for files_origin, files in sorted(repository.load_snapshot(
+                name)["origins"].items()):
+            if origin and files_origin != origin:
+                continue
+            for relative, (size, mtime, _) in sorted(files.items()):
+                if fnmatch.fnmatch(relative, pattern) or (
+                        fnmatch.fnmatch(relative, "*/" + pattern)):
+                    found.append((name, files_origin, relative, size, mtime))
+    return found
+
+
+def list_all_snapshots(folder):
+    """Return sorted snapshot names on folder, for zip or dedup mode."""
+    if config["REPOSITORY_MODE"] == "dedup":
+        repository_folder = os.path.join(folder, REPOSITORY_FOLDER)
+        if not os.path.isdir(repository_folder):
+            return []
+        return DedupRepository(repository_folder).list_snapshots()
+    return list_snapshots(folder)
+
+
+def command_backup(args):
+    """Run 1 backup without GUI, from config or command line folders."""
+    if not config["MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY"]:
+        if windows_is_running_on_battery():  # if is windows on battery ?
+            log.warning("Running on Battery, skipping Backup.")
+            return 0
+    origins = check_origins_folders(args.origin or config["MAKE_BACKUP_FROM"])
+    if not origins:
+        log.critical("Vacap is not properly configured, Exiting...")
+        return 1
+    destination, snapshot = check_destination_folder(
+        args.destination or config["SAVE_BACKUP_TO"])
+    engine = BackupEngine(snapshot, origins)
+    engine.make_backup()
+    return 1 if engine.report.counters.get("errors") else 0
+
+
+def command_daemon(args):
+    """Run scheduled backups forever without GUI, for systemd or services."""
+    scheduler = Scheduler(get_schedules(), config["SCHEDULE_JITTER_SECONDS"],
+                          config["SCHEDULE_CATCH_UP"])
+    while True:
+        due, origins = scheduler.pop_due()
+        if due:
+            args.origin, args.destination = origins, None
+            try:
+                command_backup(args)
+            except Exception as error:  # keep the daemon alive, next time
+                log.exception(error)
+        time.sleep(scheduler.seconds_to_next())
+
+
+def command_verify(args):
+    """Verify a snapshot, by default the latest one."""
+    snapshots = list_all_snapshots(config["SAVE_BACKUP_TO"])
+    snapshot = args.snapshot or (snapshots[-1] if snapshots else None)
+    if snapshot not in snapshots:
+        log.critical("No snapshot {} to verify.".format(snapshot))
+        return 1
+    failures = verify_snapshot(config["SAVE_BACKUP_TO"], snapshot,
+                               args.sample, args.jobs)
+    for failure in failures:
+        print(failure)
+    print("{}: {}".format(snapshot, "CORRUPT" if failures else "OK"))
+    return 1 if failures else 0
+
+
+def command_restore(args):
+    """Restore 1 origin folder (or only some files of it) into target."""
+    if config["REPOSITORY_MODE"] == "dedup":
+        DedupRepository(os.path.join(config["SAVE_BACKUP_TO"],
+                                     REPOSITORY_FOLDER)).restore(
+            args.origin, args.target, args.snapshot, args.path)
+    elif args.path:
+        restore_files(config["SAVE_BACKUP_TO"], args.origin, args.path,
+                      args.target, args.snapshot)
+    else:
+        restore_backup(config["SAVE_BACKUP_TO"], args.origin, args.target,
+                       args.snapshot)
+    return 0
+
+
+def print_files(files):
+    """Print (snapshot, origin, path, size, mtime) of files, 1 per line."""
+    for snapshot, origin, path, size, mtime in files:
+        print("{}  {:>12}  {}  {}".format(
+            snapshot, size, datetime.fromtimestamp(mtime).strftime(
+                "%Y-%m-%d %H:%M:%S"), os.path.join(origin, path)))
+
+
+def command_ls(args):
+    """List files of a snapshot, by default the latest one."""
+    snapshots = list_all_snapshots(config["SAVE_BACKUP_TO"])
+    snapshot = args.snapshot or (snapshots[-1] if snapshots else None)
+    if snapshot not in snapshots:
+        log.critical("No snapshot {} to list.".format(snapshot))
+        return 1
+    print_files(find_files(config["SAVE_BACKUP_TO"], "*", args.origin,
+                           snapshot))
+    return 0
+
+
+def command_find(args):
+    """Find files by name or glob pattern on all snapshots."""
+    files = find_files(config["SAVE_BACKUP_TO"], args.pattern, args.origin)
+    print_files(files)
+    return 0 if files else 1
+
+
+def command_status(args):
+    """Print config, snapshots and last run report as JSON."""
+    destination = config["SAVE_BACKUP_TO"]
+    report_file, last_report = os.path.join(destination, REPORT_FILENAME), None
+    if os.path.isfile(report_file):
+        with open(report_file, "r", encoding="utf-8") as reports:
+            for line in reports:
+                last_report = line
+    print(dumps({
+        "version": __version__, "config_file": CONFIG_FILENAME,
+        "config": config, "snapshots": list_all_snapshots(destination),
+        "free_space_bytes": get_free_space_on_disk(destination),
+        "running_on_battery": windows_is_running_on_battery(),
+        "last_report": loads(last_report) if last_report else None,
+    }, ensure_ascii=False, indent=4, sort_keys=True))
+    return 0
+
+
+def command_prune(args):
+    """Prune snapshots by the retention policy, --keep only for dedup."""
+    policy = get_retention_policy()
+    if args.max_size is not None:
+        args.max_size *= 1024 * 1024
+    for key in policy:
+        if getattr(args, key) is not None:
+            policy[key] = getattr(args, key)
+    try:
+        with lock_destination(config["SAVE_BACKUP_TO"],
+                              "zip" if args.keep is None else "dedup"):
+            if args.keep is None:
+                names = apply_retention(config["SAVE_BACKUP_TO"], policy,
+                                        args.dry_run)
+            else:
+                repository = DedupRepository(os.path.join(
+                    config["SAVE_BACKUP_TO"], REPOSITORY_FOLDER))
+                names = repository.prune(args.keep)
+                if not args.no_gc:
+                    repository.gc()
+    except OSError as reason:
+        log.critical(reason)
+        return 1
+    for name in names:
+        print(name)
+    return 0
+
+
+def command_gc(args):
+    """Reclaim space of chunks not referenced by any dedup snapshot."""
+    try:
+        with lock_destination(config["SAVE_BACKUP_TO"], "dedup"):
+            print(DedupRepository(os.path.join(config["SAVE_BACKUP_TO"],
+                                               REPOSITORY_FOLDER)).gc())
+    except OSError as reason:
+        log.critical(reason)
+        return 1
+    return 0
+
+
+def command_tray(args):
+    """Run the system tray GUI, the only command that imports PyQt5."""
+    from vacap_gui import run_tray  # lazy, PyQt5 is slow and heavy to import
+    signal.signal(signal.SIGINT, signal.SIG_DFL)  # CTRL+C work to quit app
+    return run_tray()
+
+
+def parse_arguments(argv=None):
+    """Parse command line arguments, no command means tray."""
+    parser = argparse.ArgumentParser(prog="vacap", description=__doc__)
+    parser.add_argument("--version", action="version", version=__version__)
+    parser.set_defaults(function=command_tray)
+    commands = parser.add_subparsers()
+    commands.add_parser("tray", help="run system tray GUI (default)")
+    backup = commands.add_parser("backup", help="make 1 backup, no GUI")
+    backup.set_defaults(function=command_backup)
+    backup.add_argument("--origin", action="append",
+                        help="folder to backup, repeatable, default config")
+    backup.add_argument("--destination", help="default from config")
+    commands.add_parser("daemon", help="run scheduled backups, no GUI"
+                        ).set_defaults(function=command_daemon)
+    verify = commands.add_parser("verify", help="verify a snapshot")
+    verify.set_defaults(function=command_verify)
+    verify.add_argument("snapshot", nargs="?", help="default latest")
+    verify.add_argument("--sample", type=int, default=0,
+                        help="verify only this many random files")
+    verify.add_argument("--jobs", type=int, default=0,
+                        help="parallel checks, default auto")
+    restore = commands.add_parser("restore", help="restore a folder")
+    restore.set_defaults(function=command_restore)
+    restore.add_argument("origin", help="folder as it was backed up")
+    restore.add_argument("target", help="folder to restore into")
+    restore.add_argument("--snapshot", help="default latest")
+    restore.add_argument("--path", action="append",
+                         help="file relative to origin, repeatable")
+    ls = commands.add_parser("ls", help="list files of a snapshot")
+    ls.set_defaults(function=command_ls)
+    ls.add_argument("snapshot", nargs="?", help="default latest")
+    ls.add_argument("--origin", help="default all")
+    find = commands.add_parser("find", help="find files on all snapshots")
+    find.set_defaults(function=command_find)
+    find.add_argument("pattern", help="name or glob pattern, like *.txt")
+    find.add_argument("--origin", help="default all")
+    commands.add_parser("status", help="print status as JSON").set_defaults(
+        function=command_status)
+    prune = commands.add_parser("prune", help="prune expired snapshots")
+    prune.set_defaults(function=command_prune)
+    prune.add_argument("--keep", type=int,
+                       help="dedup only, how many newest snapshots to keep")
+    prune.add_argument("--no-gc", action="store_true",
+                       help="with --keep, do not reclaim space after pruning")
+    for key in ("last", "daily", "weekly", "monthly"):
+        prune.add_argument("--keep-" + key, dest=key, type=int,
+                           help="default KEEP_{} from config".format(
+                               key.upper()))
+    prune.add_argument("--max-size-mb", dest="max_size", type=int,
+                       help="default MAX_TOTAL_SIZE_MB from config")
+    prune.add_argument("--dry-run", action="store_true",
+                       help="only print what would be removed")
+    commands.add_parser("gc", help="reclaim unreferenced dedup chunks"
+                        ).set_defaults(function=command_gc)
+    return parser.parse_args(argv)
 
 
 ##############################################################################
 
 
-def main():
+def main(argv=None):
     """Main Loop."""
+    args = parse_arguments(argv)
     log_file_path = os.path.join(gettempdir(), "vacap.log")
-    log.basicConfig(level=-1, filemode="w", filename=log_file_path,
-                    format="%(levelname)s:%(asctime)s %(message)s %(lineno)s")
+    log.basicConfig(level=-1, handlers=[RotatingFileHandler(
+        log_file_path, maxBytes=10 * 1024 * 1024, backupCount=5,
+        encoding="utf-8")],  # keep logs of previous runs, not overwrite them
+        format="%(levelname)s:%(asctime)s %(message)s %(lineno)s")
     log.getLogger().addHandler(log.StreamHandler(sys.stderr))
     log.info(__doc__)
     log.debug("LOG File: '{}'.".format(log_file_path))
     log.debug("Free Space on Disk: ~{} GigaBytes.".format(
         get_free_space_on_disk_on_gb(os.path.expanduser("~"))))
     log.debug("Running on Battery: {}".format(windows_is_running_on_battery()))
-    signal.signal(signal.SIGINT, signal.SIG_DFL)  # CTRL+C work to quit app
-    app = QApplication(sys.argv)
-    app.setApplicationName("vacap")
-    app.setOrganizationName("vacap")
-    app.setOrganizationDomain("vacap")
-    icon = QIcon(app.style().standardPixmap(QStyle.SP_DriveFDIcon))
-    app.setWindowIcon(icon)
-    win = MainWindow(icon)
-    win.show()
-    sys.exit(app.exec_())
+    if args.function is not command_tray:  # tray asks config with a wizard
+        try:
+            get_or_set_config()
+        except FileNotFoundError as reason:
+            log.critical(reason)
+            return 1
+    try:
+        return args.function(args)
+    except (FileNotFoundError, ValueError) as reason:  # bad path or snapshot
+        log.critical(reason)
+        return 1
 
 
 if __name__ in '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Vacap Benchmark, headless benchmark of the backup pipeline."""
+
+
+# imports
+import argparse
+import ctypes
+import logging as log
+import os
+import random
+import shutil
+import sys
+import time
+from json import dumps, loads
+from tempfile import mkdtemp
+
+import vacap
+
+
+##############################################################################
+# Synthetic datasets are reproducible: same --seed and --scale gives the
+# same tree, byte by byte, so results are comparable between versions.
+
+
+WORDS = ("backup vacap copia seguridad archivo carpeta datos documento "
+         "informe factura cliente proyecto lunes martes viernes hora dia "
+         "the of and to in is that for it as with was on be at by this "
+         "lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         ).split()
+DATASETS = ("tiny", "huge", "deep", "incompressible")
+BLOCK_SIZE = 1024 * 1024
+
+
+def make_text(rng, size):
+    """Return size bytes of random words."""
+    words, length = [], 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).encode("ascii")[:size]
+
+
+TEXT = make_text(random.Random(0), BLOCK_SIZE)  # rotated, way faster
+
+
+def text_block(rng, size):
+    """Return size bytes of compressible text, like documents or logs."""
+    offset = rng.randrange(BLOCK_SIZE)
+    return (TEXT[offset:] + TEXT[:offset])[:size]
+
+
+def random_block(rng, size):
+    """Return size bytes of incompressible data, like photos or videos."""
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def write_file(path, rng, size, make_block):
+    """Write size bytes generated by make_block to path, block by block."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as synthetic_file:
+        while size > 0:
+            block = make_block(rng, min(size, BLOCK_SIZE))
+            synthetic_file.write(block)
+            size -= len(block)
+
+
+def generate_dataset(folder, dataset, scale=1.0, seed=42):
+    """Generate a synthetic tree of dataset kind on folder, return stats."""
+    rng, files, total = random.Random("{}-{}".format(seed, dataset)), 0, 0
+    if dataset == "tiny":  # many tiny files on many folders
+        for number in range(int(20000 * scale)):
+            size = rng.randint(0, 4096)
+            write_file(os.path.join(folder, "d{:03d}".format(number % 200),
+                                    "f{:06d}.txt".format(number)),
+                       rng, size, text_block)
+            files, total = files + 1, total + size
+    elif dataset == "huge":  # a few huge files, half text half binary
+        for number in range(4):
+            size = int(256 * 1024 * 1024 * scale)
+            write_file(os.path.join(folder, "huge{}.dat".format(number)), rng,
+                       size, text_block if number % 2 else random_block)
+            files, total = files + 1, total + size
+    elif dataset == "deep":  # deep nesting, few files per level
+        path = folder
+        for depth in range(int(64 * scale) or 1):
+            path = os.path.join(path, "nivel{:02d}".format(depth))
+            for number in range(8):
+                size = rng.randint(1024, 64 * 1024)
+                write_file(os.path.join(path, "f{}.txt".format(number)),
+                           rng, size, text_block)
+                files, total = files + 1, total + size
+    elif dataset == "incompressible":  # media like, random data
+        for number in range(int(200 * scale)):
+            size = rng.randint(256 * 1024, 4 * 1024 * 1024)
+            write_file(os.path.join(folder, "media{:04d}.raw".format(number)),
+                       rng, size, random_block)
+            files, total = files + 1, total + size
+    else:
+        raise ValueError("Unknown dataset {}.".format(dataset))
+    return {"files": files, "bytes": total}
+
+
+##############################################################################
+
+
+def get_peak_rss():
+    """Return peak resident memory in KiloBytes, of self and of children."""
+    try:
+        import resource
+    except ImportError:  # MS Windows
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong),
+                        ("PageFaultCount", ctypes.c_ulong),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters), counters.cb)
+        return {"self": counters.PeakWorkingSetSize // 1024, "children": None}
+    unit = 1024 if sys.platform == "darwin" else 1  # macOS uses Bytes
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // unit,
+        "children": resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss // unit}
+
+
+def measure(stats, function, *args):
+    """Run function(*args), return (result, timings with throughput)."""
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = max(time.perf_counter() - start, 1e-9)
+    return result, {
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(stats["bytes"] / 1024 / 1024 / seconds, 2),
+        "files_per_s": round(stats["files"] / seconds, 2)}
+
+
+def benchmark_dataset(workdir, dataset, scale, seed):
+    """Benchmark every stage of the backup pipeline on dataset."""
+    origin = os.path.join(workdir, "origin_" + dataset)
+    destination = os.path.join(workdir, "destination_" + dataset)
+    os.makedirs(destination)
+    start = time.perf_counter()
+    stats = generate_dataset(origin, dataset, scale, seed)
+    generate_seconds = round(time.perf_counter() - start, 4)
+    state, scan = measure(stats, vacap.scan_folder_state, origin)
+    manifest = {"origin": origin, "deleted": [], "type": "full",
+                "base": None}
+    zip_filename, archive = measure(
+        stats, vacap.write_backup_zip, os.path.join(destination, "b.zip"),
+        origin, sorted(state), manifest, None, vacap.config)
+    _, checksum = measure(stats, vacap.hash_file, zip_filename,
+                          vacap.get_checksum_algorithm())
+    snapshot = os.path.join(destination, "2000-01-01t00_00_00")
+    os.mkdir(snapshot)
+    engine = vacap.BackupEngine(snapshot, [origin])
+    _, make_backup = measure(stats, engine.make_backup)
+    output_size = os.path.getsize(zip_filename)
+    return {
+        "dataset": dict(stats, generate_seconds=generate_seconds),
+        "output_bytes": output_size,
+        "compression_ratio": round(output_size / (stats["bytes"] or 1), 4),
+        "stages": {"scan": scan, "archive": archive, "checksum": checksum,
+                   "engine": make_backup}}
+
+
+def parse_value(value):
+    """Parse a --set value as JSON, fallback to plain string."""
+    try:
+        return loads(value)
+    except ValueError:
+        return value
+
+
+def main(argv=None):
+    """Main Loop."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dataset", action="append", choices=DATASETS,
+                        help="dataset to benchmark, repeatable, default all")
+    parser.add_argument("--scale", type=float, default=0.1,
+                        help="multiply dataset sizes, 1.0 is ~1.5 GigaBytes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="KEY=VALUE", help="override a config key")
+    parser.add_argument("--workdir", help="folder for the synthetic trees")
+    parser.add_argument("--keep", action="store_true",
+                        help="do not delete the synthetic trees at the end")
+    parser.add_argument("--output", help="write JSON report to this file")
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.WARNING)
+    vacap.config = dict(vacap.CONFIG_DEFAULTS)
+    for override in args.set:
+        key, value = override.split("=", 1)
+        vacap.config[key] = parse_value(value)
+    workdir = mkdtemp(prefix="vacap_benchmark_", dir=args.workdir)
+    report = {"version": vacap.__version__, "python": sys.version,
+              "platform": sys.platform, "cpus": os.cpu_count(),
+              "scale": args.scale, "seed": args.seed,
+              "config": vacap.config, "results": {}}
+    try:
+        for dataset in args.dataset or DATASETS:
+            report["results"][dataset] = benchmark_dataset(
+                workdir, dataset, args.scale, args.seed)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report["peak_rss_kb"] = get_peak_rss()
+    output = dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as report_file:
+            report_file.write(output)
+    print(output)
+
+
+if __name__ in '__main__':
+    main()
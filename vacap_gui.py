@@ -0,0 +1,274 @@
+#!C:/Python34/pythonw.exe
+# -*- coding: utf-8 -*-
+
+
+"""Vacap GUI, system tray icon and dialogs, the only part using PyQt5."""
+
+
+# imports
+import logging as log
+import os
+import sys
+import time
+from datetime import datetime
+from json import dumps
+from tempfile import gettempdir
+
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
+from PyQt5.QtGui import QCursor, QFont, QIcon
+from PyQt5.QtWidgets import (QApplication, QFileDialog, QInputDialog, QMenu,
+                             QMessageBox, QProgressDialog, QStyle,
+                             QSystemTrayIcon)
+
+import vacap
+
+
+CSS_STYLE = """
+    QMenu, QProgressDialog {
+        background-color: qlineargradient(
+            spread: reflect, x1: 0.5, y1: 0.5, x2: 0, y2: 0,
+            stop: 0 lightcyan, stop: 1 limegreen, stop: 1 skyblue);
+        border-left: 9px solid lightgreen;
+    }
+"""
+
+
+def ask_config():
+    """Ask the user for a new config with dialogs, None if not confirmed."""
+    days = ["Lunes", "Martes", "Miercoles",
+            "Jueves", "Viernes", "Sabado", "Domingo"]
+    QMessageBox.information(None, vacap.__doc__,
+                            "<b>Vamos a Configurar Vacap!.")
+    msg = "<b>Hacer un Backup Copia de Seguridad al Iniciar la compu ?."
+    _st = QMessageBox.question(
+        None, vacap.__doc__, msg, QMessageBox.Yes | QMessageBox.No,
+        QMessageBox.No) == QMessageBox.Yes
+    msg = "<b>Hacer Backup Copia de Seguridad si la compu esta a Bateria ?"
+    _bt = QMessageBox.question(
+        None, vacap.__doc__, msg, QMessageBox.Yes | QMessageBox.No,
+        QMessageBox.Yes) == QMessageBox.Yes
+    msg = "<b>Que Dia de la Semana Hacer Backup Copia de Seguridad ?."
+    _day = str(QInputDialog.getItem(
+        None, vacap.__doc__, msg, days, 4, False)[0]).lower()
+    msg = "<b>A que Hora del Dia hacer Hacer Backup Copia de Seguridad ?."
+    _hour = int(QInputDialog.getInt(None, vacap.__doc__, msg, 12, 1, 23)[0])
+    msg = "<b>Donde Guardar el Backup Copia de Seguridad ?."
+    QMessageBox.information(None, vacap.__doc__, msg)
+    _trg = QFileDialog.getExistingDirectory(None, vacap.__doc__, gettempdir())
+    msg = "<b>Agregar 1 Carpeta para hacer Backup Copia de Seguridad ?."
+    _backup_from = []
+    while QMessageBox.question(
+        None, vacap.__doc__, msg, QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.Yes) == QMessageBox.Yes:
+        _backup_from.append(str(QFileDialog.getExistingDirectory(
+            None, vacap.__doc__, os.path.expanduser("~"))))
+    configura = {
+        "MAKE_BACKUP_FROM": _backup_from,
+        "SAVE_BACKUP_TO": _trg,
+        "MAKE_BACKUP_ON_STARTUP": _st,
+        "MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY": _bt,
+        "MAKE_BACKUP_ON_WEEK_DAY": _day,
+        "MAKE_BACKUP_AT_THIS_HOUR": _hour,
+    }
+    configura.update(vacap.CONFIG_DEFAULTS)
+    summary = dumps(configura, ensure_ascii=False, indent=4, sort_keys=True)
+    log.debug("Configuration: {}.".format(summary))
+    confirm = QInputDialog.getMultiLineText(
+        None, vacap.__doc__, "<b>Resumen Final de la Configuracion:",
+        summary)[1]
+    return configura if confirm else None
+
+
+class BackupWorker(QThread):
+
+    """Thread running the BackupEngine, so the GUI never freezes."""
+
+    progress = pyqtSignal(str, object, object)  # object: may not fit on int
+
+    def __init__(self, destination, origins, parent=None):
+        """Init class."""
+        super(BackupWorker, self).__init__(parent)
+        self.destination, self.origins = destination, origins
+
+    def run(self):
+        """Run the backup engine, emitting progress signals."""
+        vacap.BackupEngine(self.destination, self.origins,
+                           self.progress.emit).make_backup()
+
+
+class Backuper(QProgressDialog):
+
+    """Backuper Dialog with complete informations and progress bar."""
+
+    def __init__(self, destination, origins, parent=None):
+        """Init class."""
+        super(Backuper, self).__init__(parent)
+        self.setWindowTitle(vacap.__doc__)
+        self.setWindowIcon(
+            QIcon(QApplication.style().standardPixmap(QStyle.SP_DriveFDIcon)))
+        self.setWindowFlags(Qt.FramelessWindowHint)
+        self.setCancelButton(None)
+        self._time, self._date = time.time(), datetime.now().isoformat()[:-7]
+        self.destination, self.origins = destination, origins
+        self.template = """<h3>Copia de Seguridad BackUp</h3><hr><table>
+        <tr><td><b>Desde:</b></td>      <td>{}</td>
+        <tr><td><b>Hacia:  </b></td>      <td>{}</td> <tr>
+        <tr><td><b>Tiempo de Inicio:</b></td>   <td>{}</td>
+        <tr><td><b>Tiempo Actual:</b></td>    <td>{}</td> <tr>
+        <tr><td><b>Tiempo Transcurrido:</b></td>   <td>{}</td>
+        <tr><td><b>Faltante:</b></td> <td>{}</td> <tr>
+        <tr><td><b>Porcentaje:</b></td>     <td>{}%</td></table><hr>
+        <i>Por favor no toque nada hasta que termine, proceso trabajando</i>"""
+        self.setStyleSheet(CSS_STYLE)
+        self.show()
+        self.center()
+        self.setValue(0)
+        self.setLabelText(self.template)
+
+    def center(self):
+        """Center the Window on Current Screen,with MultiMonitor support."""
+        window_geometry = self.frameGeometry()
+        mousepointer_position = QApplication.desktop().cursor().pos()
+        screen = QApplication.desktop().screenNumber(mousepointer_position)
+        centerPoint = QApplication.desktop().screenGeometry(screen).center()
+        window_geometry.moveCenter(centerPoint)
+        self.move(window_geometry.topLeft())
+
+    def closeEvent(self, event):
+        """Force NO Quit."""
+        return event.ignore()
+
+    def seconds_time_to_human_str(self, time_on_seconds=0):
+        """Calculate time, with precision from seconds to days."""
+        minutes, seconds = divmod(int(time_on_seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+        human_time_string = ""
+        if days:
+            human_time_string += "%02d Dias " % days
+        if hours:
+            human_time_string += "%02d Horas " % hours
+        if minutes:
+            human_time_string += "%02d Minutos " % minutes
+        human_time_string += "%02d Segundos" % seconds
+        return human_time_string
+
+    def update_progress(self, folder_to_backup, done_bytes, total_bytes):
+        """Update the label and progress bar, connected to BackupWorker."""
+        percentage = int(done_bytes / total_bytes * 100) if total_bytes else 0
+        self.setLabelText(self.template.format(
+            folder_to_backup[:99], self.destination.lower()[:99],
+            self._date, datetime.now().isoformat()[:-7],
+            self.seconds_time_to_human_str(time.time() - self._time),
+            "~{} MegaBytes".format(
+                int((total_bytes - done_bytes) / 1024 / 1024)), percentage))
+        self.setValue(percentage)
+
+
+##############################################################################
+
+
+class MainWindow(QSystemTrayIcon):
+
+    """Main widget for Vacap, not really a window since not needed."""
+
+    def __init__(self, icon, parent=None):
+        """Tray icon main widget."""
+        super(MainWindow, self).__init__(icon, parent)
+        log.info("Iniciando el programa Vacap...")
+        config = vacap.get_or_set_config(ask_config)
+        self.origins = config["MAKE_BACKUP_FROM"]
+        self.destination = config["SAVE_BACKUP_TO"]
+        self.worker, self.dialog, self.pending_backup = None, None, False
+        self.setToolTip(vacap.__doc__ + "\n1 Click y 'Hacer Backup'!")
+        self.traymenu = QMenu("Backup")
+        self.traymenu.setIcon(icon)
+        self.traymenu.addAction(icon, "Hacer Backup", lambda: self.backup())
+        self.traymenu.setFont(QFont("Verdana", 10, QFont.Bold))
+        self.setContextMenu(self.traymenu)
+        self.activated.connect(self.click_trap)
+        self.contextMenu().setStyleSheet(CSS_STYLE)
+        vacap.add_to_startup()
+        log.info("Inicio el programa Vacap.")
+        self.show()
+        self.showMessage("Vacap", "Copia de Seguridad Backup funcionando.")
+        if config["MAKE_BACKUP_ON_STARTUP"]:
+            log.info("Running Backup on Start-Up.")
+            self.backup()
+        self.scheduler = vacap.Scheduler(
+            vacap.get_schedules(), config["SCHEDULE_JITTER_SECONDS"],
+            config["SCHEDULE_CATCH_UP"])
+        if self.scheduler.schedules:
+            log.info("Running Automatic Backup by Scheduled Cron.")
+            self.timer = QTimer(self)
+            self.timer.setSingleShot(True)  # re-armed to the next fire time
+            self.timer.timeout.connect(self.run_scheduled_backups)
+            self.run_scheduled_backups()
+
+    def click_trap(self, value):
+        """Trap the mouse tight click."""
+        if value == self.Trigger:  # left click
+            self.traymenu.exec_(QCursor.pos())
+
+    def run_scheduled_backups(self):
+        """Run Automatic Backup if a Schedule is due, then sleep until next."""
+        due, origins = self.scheduler.pop_due()
+        if due:
+            log.info("Running Automatic Backup by Scheduled Cron.")
+            self.backup(origins)
+        self.timer.start(int(self.scheduler.seconds_to_next() * 1000))
+
+    def backup(self, origins=None):
+        """Backup desde MAKE_BACKUP_FROM (u origins) hacia SAVE_BACKUP_TO."""
+        origins = origins or self.origins
+        if self.worker is not None and self.worker.isRunning():
+            log.info("Backup already running, merged into the next one.")
+            self.pending_backup = sorted(  # many requests merge into 1 backup
+                set(self.pending_backup or []) | set(origins))
+            return
+        if not vacap.config["MAKE_BACKUP_WHEN_RUNNING_ON_BATTERY"]:
+            if vacap.windows_is_running_on_battery():  # if on battery ?
+                return  # if on battery and should not make backup, then return
+        self.contextMenu().setDisabled(True)
+        destination, snapshot = vacap.check_destination_folder(
+            self.destination)
+        origins = vacap.check_origins_folders(origins)
+        if origins:
+            log.info("Starting to BackUp folders...")
+            self.dialog = Backuper(destination=snapshot, origins=origins)
+            self.worker = BackupWorker(snapshot, origins, self)
+            self.worker.progress.connect(self.dialog.update_progress)
+            self.worker.finished.connect(self.backup_finished)
+            self.worker.start(QThread.LowPriority)  # keep the UI snappy
+        else:
+            log.critical("Vacap is not properly configured, Exiting...")
+            sys.exit(1)
+
+    def backup_finished(self):
+        """Backup worker thread finished, run merged pending backup if any."""
+        self.dialog.hide()
+        self.dialog.deleteLater()
+        self.worker.deleteLater()
+        self.worker, self.dialog = None, None
+        self.contextMenu().setDisabled(False)
+        self.showMessage("Vacap", "Copia de Seguridad Backup Termino bien")
+        if self.pending_backup:
+            log.info("Running merged Backup requested while running.")
+            origins, self.pending_backup = self.pending_backup, False
+            self.backup(origins)
+
+
+##############################################################################
+
+
+def run_tray():
+    """Run the system tray icon until the user quits."""
+    app = QApplication(sys.argv)
+    app.setApplicationName("vacap")
+    app.setOrganizationName("vacap")
+    app.setOrganizationDomain("vacap")
+    icon = QIcon(app.style().standardPixmap(QStyle.SP_DriveFDIcon))
+    app.setWindowIcon(icon)
+    win = MainWindow(icon)
+    win.show()
+    return app.exec_()